@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# @Author: Ultraxime
+# @Date:   2026-10-18 17:12:30
+# @Last Modified by:   Ultraxime
+# @Last Modified time: 2026-10-18 17:12:30
+
+"""
+Compare the bytes on the wire and the time of the compressions of a full
+UPDATE.
+
+Run from the repository root: python -m benchmarks.compression
+"""
+
+import sys
+from typing import Dict, Optional, Tuple
+
+from src.protocol import decode, encode
+
+from .engine import measure
+from .generators import make_tree
+
+# Compression and level tried, None for none
+SETTINGS: Tuple[Tuple[Optional[str], Optional[int]], ...] = (
+    (None, None), ("zlib", 1), ("zlib", 6), ("zlib", 9), ("lzma", 0),
+    ("lzma", 6))
+
+
+def run(size: int, repeat: int = 3) -> Dict[str, Dict[str, float]]:
+    """
+    Encode and decode an UPDATE of size keys with every setting
+
+    :param      size:    The number of keys
+    :type       size:    int
+    :param      repeat:  The number of runs of each operation
+    :type       repeat:  int
+
+    :returns:   the size and durations by setting
+    :rtype:     dict
+    """
+    message = {"UPDATE": make_tree(size), "SEQ": 1}
+    results: Dict[str, Dict[str, float]] = {}
+    raw = len(encode(message))
+    for compression, level in SETTINGS:
+        name = "none" if compression is None else compression + str(level)
+        frame = encode(message, compression, 0, level)
+        results[name] = {
+            "bytes": len(frame),
+            "ratio": len(frame) / raw,
+            "encode_ms": measure(lambda c=compression, l=level:
+                                 encode(message, c, 0, l),
+                                 repeat)["median_ms"],
+            "decode_ms": measure(lambda f=frame: decode(f),
+                                 repeat)["median_ms"]}
+    return results
+
+
+if __name__ == "__main__":
+    print(f"{'keys':10}{'setting':10}{'bytes':>12}{'ratio':>8}"
+          f"{'encode ms':>12}{'decode ms':>12}")
+    for tree_size in [int(arg) for arg in sys.argv[1:]] or [1000, 10000]:
+        for setting, result in run(tree_size).items():
+            print(f"{tree_size:<10}{setting:10}{result['bytes']:12.0f}"
+                  f"{result['ratio']:8.3f}{result['encode_ms']:12.3f}"
+                  f"{result['decode_ms']:12.3f}")
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+# @Author: Ultraxime
+# @Date:   2026-10-18 15:10:21
+# @Last Modified by:   Ultraxime
+# @Last Modified time: 2026-10-18 15:10:21
+
+"""Time the operations of SshKeyDict on synthetic trees"""
+
+import os
+import random
+import statistics
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+from src.ssh_keys import SshKeyDict
+
+from .generators import make_key, make_tree
+
+# Number of keys added then removed by the add/remove operations
+CHANGES = 100
+
+
+def measure(operation: Callable[[], Any], repeat: int,
+            setup: Optional[Callable[[], Any]] = None) -> Dict[str, float]:
+    """
+    Run operation repeat times and summarize the durations
+
+    :param      operation:  The operation
+    :type       operation:  Callable
+    :param      repeat:     The number of runs
+    :type       repeat:     int
+    :param      setup:      Run before each run, out of the timing
+    :type       setup:      Callable, optional
+
+    :returns:   the median and minimum durations in milliseconds
+    :rtype:     dict
+    """
+    durations: List[float] = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        operation()
+        durations.append((time.perf_counter() - start) * 1000)
+    return {"median_ms": statistics.median(durations),
+            "min_ms": min(durations)}
+
+
+def run(size: int, layout: str = "nested",
+        repeat: int = 5) -> Dict[str, Dict[str, float]]:
+    """
+    Time every operation on a tree of size keys
+
+    :param      size:    The number of keys
+    :type       size:    int
+    :param      layout:  The layout of the tree
+    :type       layout:  str
+    :param      repeat:  The number of runs of each operation
+    :type       repeat:  int
+
+    :returns:   the durations by operation
+    :rtype:     dict
+    """
+    keys = make_tree(size, layout)
+    results: Dict[str, Dict[str, float]] = {}
+    with tempfile.TemporaryDirectory() as directory:
+        filename = os.path.join(directory, "authorized_key")
+        keys.write(filename)
+        results["open"] = measure(lambda: SshKeyDict.open(filename), repeat)
+        results["str"] = measure(lambda: str(keys), repeat)
+        state: Dict[str, Any] = {}
+
+        def change():
+            state["seed"] = state.get("seed", 0) + 1
+            state["tree"] = make_tree(size, layout, state["seed"])
+        results["write"] = measure(lambda: state["tree"].write(filename),
+                                   repeat, change)
+        results["write_unchanged"] = measure(lambda: keys.write(filename),
+                                             repeat, lambda: keys.write(
+                                                 filename))
+
+    rand = random.Random(-1)
+    additions = SshKeyDict({"bench": {"added" + str(index):
+                                      make_key(rand, index)
+                                      for index in range(CHANGES)}})
+    added = ["bench/" + path for path in additions["bench"].list_key()]
+
+    def remove():
+        for path in added:
+            keys.remove(path)
+
+    def add():
+        if "bench" not in keys:
+            keys.add(additions)
+    results["add"] = measure(lambda: keys.add(additions), repeat, remove)
+    results["remove"] = measure(remove, repeat, add)
+
+    modified = keys.copy()
+    modified.add(additions)
+    results["diff"] = measure(lambda: keys.diff(modified), repeat)
+    same = keys.copy()
+    results["diff_unchanged"] = measure(lambda: keys.diff(same), repeat)
+
+    def invalidate():
+        add()
+        remove()
+    results["list_key"] = measure(keys.list_key, repeat, invalidate)
+    results["list_key_cached"] = measure(keys.list_key, repeat,
+                                         keys.list_key)
+    return results
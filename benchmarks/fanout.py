@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+# @Author: Ultraxime
+# @Date:   2026-10-18 15:31:09
+# @Last Modified by:   Ultraxime
+# @Last Modified time: 2026-10-18 15:31:09
+
+"""
+Time an ADD from its request to the manager until every worker wrote it,
+with one manager and several workers in a child process
+"""
+
+import multiprocessing
+import os
+import random
+import socket
+import statistics
+import tempfile
+import time
+from typing import Dict, List
+
+import yaml
+import zmq
+
+from src.config import Config
+from src.manager import DEFAULT_CONFIG as MANAGER_CONFIG
+from src.manager import Manager
+from src.protocol import recv, send
+from src.ssh_keys import SshKeyDict
+from src.worker import DEFAULT_CONFIG as WORKER_CONFIG
+from src.worker import Worker
+
+from .generators import make_key, make_tree
+
+# Seconds to wait for every worker before giving up on a request
+TIMEOUT = 30.0
+
+
+def free_port() -> int:
+    """
+    Find a free tcp port on the loopback interface
+
+    :returns:   the port
+    :rtype:     int
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_config(directory: str, name: str, default: str,
+                content: dict) -> Config:
+    """
+    Write a config file in directory and load it over its default file
+
+    :param      directory:  The directory
+    :type       directory:  str
+    :param      name:       The name of the file
+    :type       name:       str
+    :param      default:    The name of the default file
+    :type       default:    str
+    :param      content:    The content of the file
+    :type       content:    dict
+
+    :returns:   the config
+    :rtype:     Config
+    """
+    path = os.path.join(directory, name)
+    with open(path, 'w', encoding="utf-8") as file:
+        yaml.safe_dump(content, file)
+    return Config(path, default)
+
+
+def wait(manager: Manager, workers: List[Worker]) -> bool:
+    """
+    Wait until every worker wrote the last change of the manager
+
+    :param      manager:  The manager
+    :type       manager:  Manager
+    :param      workers:  The workers
+    :type       workers:  list
+
+    :returns:   False on timeout
+    :rtype:     bool
+    """
+    sequence = manager.sequence
+    deadline = time.monotonic() + TIMEOUT
+    while any(worker.applied is None or worker.applied < sequence
+              for worker in workers):
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.0005)
+    return True
+
+
+def run(size: int, workers: int = 4,
+        requests: int = 50) -> Dict[str, float]:
+    """
+    Measure the latency of ADD requests of one key, in a process of its own
+
+    :param      size:      The number of keys managed
+    :type       size:      int
+    :param      workers:   The number of workers
+    :type       workers:   int
+    :param      requests:  The number of requests measured
+    :type       requests:  int
+
+    :returns:   the latency percentiles in milliseconds
+    :rtype:     dict
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        pool = multiprocessing.get_context("spawn").Pool(1)
+        try:
+            return pool.apply(measure, (directory, size, workers, requests))
+        finally:
+            # The manager and the workers cannot be stopped, their threads
+            # and sockets end with the process, before the directory goes
+            pool.terminate()
+            pool.join()
+
+
+def measure(directory: str, size: int, workers: int,
+            requests: int) -> Dict[str, float]:
+    """
+    Measure the latency of ADD requests of one key, with the manager and
+    the workers in this process
+
+    :param      directory:  The directory of the files
+    :type       directory:  str
+    :param      size:       The number of keys managed
+    :type       size:       int
+    :param      workers:    The number of workers
+    :type       workers:    int
+    :param      requests:   The number of requests measured
+    :type       requests:   int
+
+    :returns:   the latency percentiles in milliseconds
+    :rtype:     dict
+    """
+    ports = {"discord": free_port(), "worker": free_port(),
+             "snapshot": free_port(), "ack": free_port()}
+    keys = os.path.join(directory, "manager_keys")
+    make_tree(size).write(keys)
+    manager = Manager(make_config(directory, "manager.yml",
+                                  MANAGER_CONFIG, {
+        "sockets": {name: {"port": port}
+                    for name, port in ports.items()},
+        "files": {"keys": keys,
+                  "journal": os.path.join(directory, "journal"),
+                  "snapshot": os.path.join(directory, "snapshot")},
+        "metrics": {"port": None}}))
+    nodes = [Worker(make_config(directory, "worker" + str(index) + ".yml",
+                                WORKER_CONFIG, {
+        "sockets": {"manager": {"ip": "127.0.0.1",
+                                "port": ports["worker"]},
+                    "snapshot": {"port": ports["snapshot"]},
+                    "ack": {"port": ports["ack"]}},
+        "batch": {"window": 0},
+        "files": {"keys": os.path.join(directory,
+                                       "worker" + str(index))},
+        "metrics": {"port": None}}))
+        for index in range(workers)]
+    manager.start(daemon=True)
+    for node in nodes:
+        node.start(daemon=True)
+
+    context = zmq.Context.instance()
+    client = context.socket(zmq.REQ)
+    client.connect("tcp://127.0.0.1:" + str(ports["discord"]))
+    rand = random.Random(-1)
+    latencies: List[float] = []
+    try:
+        # The first requests only bring the workers up to date, until
+        # every one of them is subscribed
+        index = 0
+        while True:
+            send(client, {"ADD": SshKeyDict(
+                {"bench": {"warmup" + str(index): make_key(rand, index)}})})
+            recv(client)
+            index += 1
+            deadline = time.monotonic() + 0.5
+            while time.monotonic() < deadline and any(
+                    node.applied != manager.sequence for node in nodes):
+                time.sleep(0.001)
+            if all(node.applied == manager.sequence for node in nodes):
+                break
+        for index in range(requests):
+            start = time.perf_counter()
+            send(client, {"ADD": SshKeyDict(
+                {"bench": {"added" + str(index): make_key(rand, index)}})})
+            recv(client)
+            if not wait(manager, nodes):
+                raise TimeoutError("The workers did not apply the"
+                                   " change in time.")
+            latencies.append((time.perf_counter() - start) * 1000)
+    finally:
+        client.close(linger=0)
+    latencies.sort()
+    return {"p50_ms": statistics.median(latencies),
+            "p90_ms": latencies[int(len(latencies) * 0.9)],
+            "p99_ms": latencies[min(len(latencies) - 1,
+                                    int(len(latencies) * 0.99))],
+            "max_ms": latencies[-1]}
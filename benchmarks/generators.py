@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+# @Author: Ultraxime
+# @Date:   2026-10-18 15:02:44
+# @Last Modified by:   Ultraxime
+# @Last Modified time: 2026-10-18 15:02:44
+
+"""Synthetic authorized_key content for the benchmarks"""
+
+import math
+import random
+import struct
+from typing import Dict, List, Union
+
+from src.ssh_keys import KeyMode, SshKey, SshKeyDict
+
+
+# Keys in each group of the nested layout
+GROUP_SIZE = 50
+
+LAYOUTS = ("flat", "nested")
+
+
+def _string(data: bytes) -> bytes:
+    return struct.pack(">I", len(data)) + data
+
+
+def make_blob(rand: random.Random, mode: KeyMode) -> bytes:
+    """
+    Make a random key blob of the ssh wire format, as a real key of this
+    mode would be
+
+    :param      rand:   The random generator
+    :type       rand:   random.Random
+    :param      mode:   The mode of the key
+    :type       mode:   KeyMode
+
+    :returns:   the blob
+    :rtype:     bytes
+    """
+    if mode is KeyMode.RSA:
+        return (_string(b"ssh-rsa") + _string(b"\x01\x00\x01")
+                + _string(b"\x00\x80" + rand.randbytes(255)))
+    if mode is KeyMode.DSA:
+        return _string(b"ssh-dss") + b"".join(
+            _string(b"\x00" + rand.randbytes(size))
+            for size in (128, 20, 128, 128))
+    if mode in (KeyMode.ECDSA, KeyMode.ECDSA_SK):
+        blob = (_string(b"ecdsa-sha2-nistp256" if mode is KeyMode.ECDSA
+                        else b"sk-ecdsa-sha2-nistp256@openssh.com")
+                + _string(b"nistp256")
+                + _string(b"\x04" + rand.randbytes(64)))
+    else:
+        blob = (_string(b"ssh-ed25519" if mode is KeyMode.ED25519
+                        else b"sk-ssh-ed25519@openssh.com")
+                + _string(rand.randbytes(32)))
+    if mode in (KeyMode.ECDSA_SK, KeyMode.ED25519_SK):
+        blob += _string(b"ssh:")
+    return blob
+
+
+def make_key(rand: random.Random, index: int) -> SshKey:
+    """
+    Make a random key of a random mode
+
+    :param      rand:   The random generator
+    :type       rand:   random.Random
+    :param      index:  The index of the key, used in the comment
+    :type       index:  int
+
+    :returns:   the key
+    :rtype:     SshKey
+    """
+    mode = rand.choice(list(KeyMode))
+    return SshKey.from_blob(mode, make_blob(rand, mode),
+                            "user" + str(index) + "@host")
+
+
+def key_path(index: int, size: int, layout: str, depth: int = 3) -> str:
+    """
+    Path of the key number index in a tree of the given layout
+
+    :param      index:   The index of the key
+    :type       index:   int
+    :param      size:    The number of keys in the tree
+    :type       size:    int
+    :param      layout:  flat or nested
+    :type       layout:  str
+    :param      depth:   The number of group levels of the nested layout
+    :type       depth:   int
+
+    :returns:   the path
+    :rtype:     str
+    """
+    if layout == "flat":
+        return "user" + str(index)
+    groups = max(1, math.ceil(size / GROUP_SIZE))
+    fanout = max(2, math.ceil(groups ** (1 / depth)))
+    group = index // GROUP_SIZE
+    parts = []
+    for level in range(depth):
+        parts.append("g" + str(level) + "_"
+                     + str(group // fanout ** (depth - 1 - level) % fanout))
+    return "/".join(parts + ["user" + str(index)])
+
+
+def make_tree(size: int, layout: str = "nested",
+              seed: int = 0) -> SshKeyDict:
+    """
+    Build a tree of size random keys
+
+    :param      size:    The number of keys
+    :type       size:    int
+    :param      layout:  flat (all keys at the top) or nested (three group
+                         levels above groups of GROUP_SIZE keys)
+    :type       layout:  str
+    :param      seed:    The random seed
+    :type       seed:    int
+
+    :returns:   the tree
+    :rtype:     SshKeyDict
+    """
+    rand = random.Random(seed)
+    content: Dict[str, Union[Dict, SshKey]] = {}
+    for index in range(size):
+        parts: List[str] = key_path(index, size, layout).split("/")
+        group = content
+        for part in parts[:-1]:
+            group = group.setdefault(part, {})  # type: ignore
+        group[parts[-1]] = make_key(rand, index)
+    return SshKeyDict(content)
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# @Author: Ultraxime
+# @Date:   2026-10-18 11:40:05
+# @Last Modified by:   Ultraxime
+# @Last Modified time: 2026-10-18 11:40:05
+
+"""
+Compare the message encoding of src/protocol.py with pickle.
+
+Run from the repository root: python -m benchmarks.protocol
+"""
+
+import pickle
+import sys
+from typing import Dict
+
+from src.protocol import decode, encode
+
+from .engine import measure
+from .generators import make_tree
+
+
+def run(size: int, repeat: int = 3) -> Dict[str, Dict[str, float]]:
+    """
+    Encode and decode an UPDATE of size keys with both encodings
+
+    :param      size:    The number of keys
+    :type       size:    int
+    :param      repeat:  The number of runs of each operation
+    :type       repeat:  int
+
+    :returns:   the size and durations by encoding
+    :rtype:     dict
+    """
+    message = {"UPDATE": make_tree(size)}
+    results: Dict[str, Dict[str, float]] = {}
+    for name, dumps, loads in (("pickle", pickle.dumps, pickle.loads),
+                               ("protocol", encode, decode)):
+        frame = dumps(message)
+        results[name] = {
+            "bytes": len(frame),
+            "encode_ms": measure(lambda f=dumps: f(message),
+                                 repeat)["median_ms"],
+            "decode_ms": measure(lambda d=frame, f=loads: f(d),
+                                 repeat)["median_ms"]}
+    return results
+
+
+if __name__ == "__main__":
+    print(f"{'keys':10}{'format':10}{'bytes':>12}{'encode ms':>12}"
+          f"{'decode ms':>12}")
+    for tree_size in [int(arg) for arg in sys.argv[1:]] or [1000, 10000]:
+        for encoding, result in run(tree_size).items():
+            print(f"{tree_size:<10}{encoding:10}{result['bytes']:12.0f}"
+                  f"{result['encode_ms']:12.3f}{result['decode_ms']:12.3f}")
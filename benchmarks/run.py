@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# @Author: Ultraxime
+# @Date:   2026-10-18 15:48:37
+# @Last Modified by:   Ultraxime
+# @Last Modified time: 2026-10-18 15:48:37
+
+"""
+Run the benchmarks and save the results as JSON, to compare two commits.
+
+Run from the repository root:
+    python -m benchmarks.run --sizes 1000 10000 --output new.json \
+        --compare old.json
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import sys
+from typing import Any, Dict, Iterator, Tuple
+
+from . import compression, engine, fanout, protocol
+from .generators import LAYOUTS
+
+SUITES = ("engine", "compression", "protocol", "fanout")
+
+
+def metadata() -> Dict[str, Any]:
+    """
+    Describe where the results come from
+
+    :returns:   the commit, python version and date
+    :rtype:     dict
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], check=True,
+                                capture_output=True, text=True
+                                ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit,
+            "python": platform.python_version(),
+            "date": datetime.datetime.now(datetime.timezone.utc).isoformat()}
+
+
+def flatten(results: Dict[str, Any],
+            prefix: str = "") -> Iterator[Tuple[str, float]]:
+    """
+    Iterate on the measures of the results with their dotted name
+
+    :param      results:  The results
+    :type       results:  dict
+    :param      prefix:   The name of results
+    :type       prefix:   str
+
+    :returns:   the names and values
+    :rtype:     Iterator[Tuple[str, float]]
+    """
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from flatten(value, prefix + key + ".")
+        else:
+            yield prefix + key, value
+
+
+def compare(old: Dict[str, Any], new: Dict[str, Any]) -> None:
+    """
+    Print the measures present in both results
+
+    :param      old:  The reference results
+    :type       old:  dict
+    :param      new:  The new results
+    :type       new:  dict
+
+    :returns:   None
+    :rtype:     None
+    """
+    before = dict(flatten(old["results"]))
+    print(f"{'measure':50}{'old':>12}{'new':>12}{'change':>10}")
+    for name, value in flatten(new["results"]):
+        if name in before and before[name]:
+            print(f"{name:50}{before[name]:12.3f}{value:12.3f}"
+                  f"{(value / before[name] - 1) * 100:+9.1f}%")
+
+
+def main(argv=None) -> None:
+    """
+    Parse the arguments and run the benchmarks
+
+    :param      argv:  The arguments, sys.argv by default
+    :type       argv:  list, optional
+
+    :returns:   None
+    :rtype:     None
+    """
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run")
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        default=[1000, 10000, 100000])
+    parser.add_argument("--suites", nargs="+", choices=SUITES,
+                        default=list(SUITES))
+    parser.add_argument("--layouts", nargs="+", choices=LAYOUTS,
+                        default=list(LAYOUTS))
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--output", help="file to write the results to")
+    parser.add_argument("--compare", help="results of a previous run")
+    args = parser.parse_args(argv)
+
+    results: Dict[str, Any] = {}
+    for size in args.sizes:
+        if "engine" in args.suites:
+            for layout in args.layouts:
+                print("engine", layout, size, file=sys.stderr)
+                results.setdefault("engine", {}).setdefault(layout, {})[
+                    str(size)] = engine.run(size, layout, args.repeat)
+        if "compression" in args.suites:
+            print("compression", size, file=sys.stderr)
+            results.setdefault("compression", {})[str(size)] = \
+                compression.run(size, args.repeat)
+        if "protocol" in args.suites:
+            print("protocol", size, file=sys.stderr)
+            results.setdefault("protocol", {})[str(size)] = protocol.run(
+                size, args.repeat)
+        if "fanout" in args.suites:
+            print("fanout", size, file=sys.stderr)
+            results.setdefault("fanout", {})[str(size)] = fanout.run(
+                size, args.workers, args.requests)
+    report = {"metadata": metadata(), "results": results}
+
+    if args.output:
+        with open(args.output, 'w', encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare, 'r', encoding="utf-8") as file:
+            compare(json.load(file), report)
+
+
+if __name__ == "__main__":
+    main()
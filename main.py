@@ -7,25 +7,46 @@
 """Main execution script"""
 
 import sys
-from src.manager import Manager
-from src.worker import Worker
+from src.config import Config
 
 if __name__ == "__main__":
+    # Fails when a thread of the node is dead or, for a worker, when it
+    # lags behind the messages it received
     if len(sys.argv) == 2 and sys.argv[1] == "healthcheck":
-        sys.exit(0)
+        from src.metrics import healthcheck
+        sys.exit(healthcheck(Config.shared().get("metrics.port", 9100)))
+
+    # AuthorizedKeysCommand of sshd: main.py keys %u %f
+    # The manager and worker modules are only imported by start, to keep
+    # the logins fast.
+    if len(sys.argv) in (3, 4) and sys.argv[1] == "keys":
+        from src.lookup import authorized_keys
+        sys.exit(authorized_keys(
+            Config.shared(default="worker-config.yml"), sys.argv[2],
+            sys.argv[3] if len(sys.argv) == 4 else None))
 
     if len(sys.argv) == 3 and sys.argv[1] == "start":
+        from src.log import configure
         match sys.argv[2]:
             case "manager":
-                manager = Manager()
+                from src.manager import DEFAULT_CONFIG as MANAGER_CONFIG
+                from src.manager import Manager
+                config = Config.shared(default=MANAGER_CONFIG)
+                configure(config)
+                manager = Manager(config)
                 manager.start()
             case "worker":
-                worker = Worker()
+                from src.worker import DEFAULT_CONFIG as WORKER_CONFIG
+                from src.worker import Worker
+                config = Config.shared(default=WORKER_CONFIG)
+                configure(config)
+                worker = Worker(config)
                 worker.start()
             case typ:
                 print("Unknown type: " + typ)
                 sys.exit(1)
     else:
         sys.exit(1)
-else:
+elif __name__ != "__mp_main__":
+    # Imported again by the processes validating the keys
     sys.exit(1)
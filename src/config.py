@@ -6,29 +6,124 @@
 
 """Module use for the Config file managemnt"""
 
+from __future__ import annotations
+
+import copy
 import os
 import shutil
+import time
+from threading import Lock
+from typing import Any, Dict, Optional, Tuple
+
 import yaml
 
 
 DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)),
                                    "../default_config/")
 
+# SSH_MANAGER_SOCKETS__WORKER__PORT=25563 overrides sockets.worker.port
+ENV_PREFIX = "SSH_MANAGER_"
+
+# Minimum time in seconds between two checks of the file modification time
+RELOAD_INTERVAL = 1.0
+
+_MISSING = object()
+
 
 class Config:
     """
-    Class representing a configuration file
+    Class representing a configuration file, merged in memory with its
+    default file and the environment variables starting with ENV_PREFIX
     """
+    __instances: Dict[Tuple[str, Optional[str]], Config] = {}
+    __instances_lock = Lock()
     __content: dict
     __path: str
+    __default: Optional[str]
+    __values: Dict[str, Any]
+    __stamp: Optional[int]
+    __checked: float
 
     def __init__(self,
-                 path: str = "/config"):
+                 path: str = "/config",
+                 default: Optional[str] = None):
         self.__path = path
-        if not os.path.exists(path):
-            self.create()
-        with open(path, 'r', encoding="utf-8") as file:
-            self.__content = yaml.safe_load(file)
+        self.__default = default
+        self.__stamp = None
+        self.__checked = 0
+        self.__values = {}
+        self.__content = {}
+        self.__load()
+
+    @classmethod
+    def shared(cls, path: str = "/config",
+               default: Optional[str] = None) -> Config:
+        """
+        Gets the process wide instance for this file and default file
+
+        :param      path:     The path of the config file
+        :type       path:     str
+        :param      default:  The name of the default file in
+                              DEFAULT_CONFIG_PATH
+        :type       default:  str, optional
+
+        :returns:   the config
+        :rtype:     Config
+        """
+        with cls.__instances_lock:
+            if (path, default) not in cls.__instances:
+                cls.__instances[(path, default)] = cls(path, default)
+            return cls.__instances[(path, default)]
+
+    def __load(self) -> None:
+        try:
+            self.__stamp = os.stat(self.__path).st_mtime_ns
+            with open(self.__path, 'r', encoding="utf-8") as file:
+                self.__content = yaml.safe_load(file) or {}
+        except FileNotFoundError:
+            self.__stamp = None
+            self.__content = {}
+        merged: dict = {}
+        if self.__default is not None:
+            with open(os.path.join(DEFAULT_CONFIG_PATH, self.__default),
+                      'r', encoding="utf-8") as file:
+                merged = yaml.safe_load(file) or {}
+        self.__merge(merged, copy.deepcopy(self.__content))
+        for name, value in os.environ.items():
+            if name.startswith(ENV_PREFIX):
+                keys = name[len(ENV_PREFIX):].lower().split("__")
+                self.__place(self.__add_key(merged, keys[:-1]), keys[-1:],
+                             yaml.safe_load(value))
+        values: Dict[str, Any] = {}
+        self.__flatten(merged, "", values)
+        self.__values = values
+
+    def __refresh(self) -> None:
+        now = time.monotonic()
+        if now - self.__checked < RELOAD_INTERVAL:
+            return
+        self.__checked = now
+        try:
+            stamp: Optional[int] = os.stat(self.__path).st_mtime_ns
+        except FileNotFoundError:
+            stamp = None
+        if stamp != self.__stamp:
+            self.__load()
+
+    @staticmethod
+    def __merge(base: dict, content: dict) -> None:
+        for key, value in content.items():
+            if isinstance(value, dict) and isinstance(base.get(key), dict):
+                Config.__merge(base[key], value)
+            else:
+                base[key] = value
+
+    @staticmethod
+    def __flatten(content: dict, prefix: str, values: Dict[str, Any]) -> None:
+        for key, value in content.items():
+            values[prefix + str(key)] = value
+            if isinstance(value, dict):
+                Config.__flatten(value, prefix + str(key) + ".", values)
 
     def create(self) -> None:
         """
@@ -37,9 +132,11 @@ class Config:
         :returns:   None
         :rtype:     None
         """
-        shutil.copyfile(os.path.join(DEFAULT_CONFIG_PATH,
-                                     "discord-bot.yml"),
+        if self.__default is None:
+            raise FileNotFoundError("No default config file.")
+        shutil.copyfile(os.path.join(DEFAULT_CONFIG_PATH, self.__default),
                         self.__path)
+        self.__load()
 
     def save(self) -> None:
         """
@@ -50,36 +147,26 @@ class Config:
         """
         with open(self.__path, 'w', encoding="utf-8") as file:
             yaml.safe_dump(self.__content, file)
+        self.__load()
 
-    @staticmethod
-    def __access(content: dict, keys: list[str]):
-        if len(keys) > 1:
-            return Config.__access(content[keys[0]], keys[1::])
-        return content[keys[0]]
-
-    def get(self, key: str):
+    def get(self, key: str, default: Any = _MISSING) -> Any:
         """
         Gets the value for specified key.
 
-        :param      key:  The key
-        :type       key:  str
+        :param      key:      The key
+        :type       key:      str
+        :param      default:  The value returned if the key is missing
+        :type       default:  depends on the key
 
         :returns:   the value associated to the key
         :rtype:     depends on the key
         """
-        keys = key.split('.')
+        self.__refresh()
         try:
-            return self.__access(self.__content, keys)
+            return self.__values[key]
         except KeyError:
-            if self.__path != os.path.join(DEFAULT_CONFIG_PATH,
-                                           "discord-bot.yml"):
-                try:
-                    value = Config(os.path.join(DEFAULT_CONFIG_PATH,
-                                                "discord-bot.yml")).get(key)
-                    self.set(key, value)
-                    return value
-                except KeyError:
-                    pass
+            if default is not _MISSING:
+                return default
             raise
 
     @staticmethod
@@ -102,7 +189,8 @@ class Config:
         :rtype:     None
         """
         keys = key.split('.')
-        self.__place(self.__content, keys, value)
+        self.__place(self.__add_key(self.__content, keys[:-1]), keys[-1:],
+                     value)
         self.save()
 
     @staticmethod
@@ -110,10 +198,10 @@ class Config:
         if len(keys) > 1:
             return Config.__add_key(Config.__add_key(content, [keys[0]]),
                                     keys[1::])
-        if keys[0] in content:
-            return content[keys[0]]
-
-        content[keys[0]] = {}
+        if len(keys) == 0:
+            return content
+        if not isinstance(content.get(keys[0]), dict):
+            content[keys[0]] = {}
         return content[keys[0]]
 
     def add_key(self, key: str) -> None:
@@ -130,13 +218,6 @@ class Config:
         self.__add_key(self.__content, keys)
         self.save()
 
-    @staticmethod
-    def __has(content: dict, keys: list[str]) -> bool:
-        if len(keys) > 0:
-            return keys[0] in content and Config.__has(content[keys[0]],
-                                                       keys[1::])
-        return True
-
     def __contains__(self, key: str) -> bool:
-        keys = key.split('.')
-        return self.__has(self.__content, keys)
+        self.__refresh()
+        return key in self.__values
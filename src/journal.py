@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+# @Author: Ultraxime
+# @Date:   2026-10-18 19:02:15
+# @Last Modified by:   Ultraxime
+# @Last Modified time: 2026-10-18 19:02:15
+
+"""Module use to keep the published changes on disk"""
+
+from __future__ import annotations
+
+import logging
+import os
+import struct
+import tempfile
+from threading import Lock
+from typing import Any, BinaryIO, Dict, List, Optional, Tuple
+
+from .protocol import ProtocolError, decode, encode
+from .ssh_keys import SshKeyDict
+
+_LOGGER = logging.getLogger(__name__)
+
+_SIZE = struct.Struct("<I")
+
+
+class Journal:
+    """
+    Snapshot of the keys at a sequence number, followed by an append-only
+    file of the messages published since. compact() writes a new snapshot
+    and empties the file. The digest of the last content written to the
+    keys file is kept along, to tell a stale copy from a change by hand.
+    """
+    _path: str
+    _snapshot: str
+    _fsync: bool
+    _file: Optional[BinaryIO]
+    # Sequence number of the snapshot, the file holds the ones after it
+    _base: int
+    _written: Optional[bytes]
+    # The writer of the keys file records its digest from its own thread
+    _lock: Lock
+
+    def __init__(self, path: str, snapshot: str, fsync: bool = True) -> None:
+        self._path = path
+        self._snapshot = snapshot
+        self._fsync = fsync
+        self._file = None
+        self._base = 0
+        self._written = None
+        self._lock = Lock()
+
+    @property
+    def size(self) -> int:
+        """
+        Size in bytes of the messages appended since the last snapshot
+
+        :returns:   the size
+        :rtype:     int
+        """
+        return self._file.tell() if self._file is not None else 0
+
+    @property
+    def written(self) -> Optional[bytes]:
+        """
+        Digest of the content last written to the keys file
+
+        :returns:   the digest, None if none was recorded
+        :rtype:     bytes, optional
+        """
+        return self._written
+
+    def recover(self) -> Tuple[Optional[str], int, Optional[SshKeyDict],
+                               List[Dict[str, Any]]]:
+        """
+        Load the snapshot and apply the messages appended after it. A
+        message cut by a crash ends the file and is dropped. The replay
+        stops at the first message not leading to its HASH, whose changes
+        are kept in a new snapshot, the keys file holds the later ones.
+
+        :returns:   the epoch, the last sequence number, the keys, None
+                    without snapshot, and the messages applied
+        :rtype:     Tuple[str, int, SshKeyDict, List[Dict[str, Any]]]
+        """
+        try:
+            with open(self._snapshot, 'rb') as file:
+                state = decode(file.read())
+        except FileNotFoundError:
+            state = None
+        except ProtocolError as error:
+            _LOGGER.error("Unreadable journal snapshot: %s", error)
+            state = None
+        if state is None:
+            self._open(0, truncate=True)
+            return None, 0, None, []
+        keys: SshKeyDict = state["SNAPSHOT"]
+        epoch, sequence = state["EPOCH"], state["SEQ"]
+        self._written = state.get("WRITTEN")
+        messages = []
+        end = 0
+        consistent = True
+        try:
+            with open(self._path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            data = b""
+        while consistent and end + _SIZE.size <= len(data):
+            size, = _SIZE.unpack_from(data, end)
+            if end + _SIZE.size + size > len(data):
+                break
+            try:
+                message = decode(data[end + _SIZE.size:
+                                      end + _SIZE.size + size])
+            except ProtocolError:
+                break
+            end += _SIZE.size + size
+            if "WRITTEN" in message:
+                self._written = message["WRITTEN"]
+                continue
+            if message.get("EPOCH") != epoch or message["SEQ"] <= sequence:
+                continue
+            for name in message.get("DEL", ()):
+                keys.remove(name)
+            if "ADD" in message:
+                keys.add(message["ADD"])
+            sequence = message["SEQ"]
+            messages.append(message)
+            consistent = message["HASH"] == keys.version
+        if not consistent:
+            _LOGGER.error("The journal does not lead to the keys it"
+                          " recorded, keeping the changes up to it.",
+                          extra={"seq": sequence,
+                                 "bytes": len(data) - end})
+            self.compact(keys, epoch, sequence)
+            return epoch, sequence, keys, messages
+        if end != len(data):
+            _LOGGER.warning("Dropped the incomplete end of the journal.",
+                            extra={"bytes": len(data) - end})
+        self._open(state["SEQ"], truncate=False, end=end)
+        return epoch, sequence, keys, messages
+
+    def _open(self, base: int, truncate: bool, end: int = 0) -> None:
+        if self._file is not None:
+            self._file.close()
+        self._base = base
+        # Kept open for the appends until the next snapshot
+        self._file = open(self._path, 'ab')  # pylint: disable=R1732
+        self._file.truncate(0 if truncate else end)
+        self._file.seek(0 if truncate else end)
+
+    def append(self, frame: bytes) -> None:
+        """
+        Add a published message at the end of the journal
+
+        :param      frame:  The encoded message, with its EPOCH, SEQ and HASH
+        :type       frame:  bytes
+
+        :returns:   None
+        :rtype:     None
+        """
+        with self._lock:
+            assert self._file is not None
+            self._file.write(_SIZE.pack(len(frame)) + frame)
+            self._file.flush()
+            if self._fsync:
+                os.fsync(self._file.fileno())
+
+    def mark_written(self, digest: bytes) -> None:
+        """
+        Record the digest of the content written to the keys file
+
+        :param      digest:  The SHA256 of the file
+        :type       digest:  bytes
+
+        :returns:   None
+        :rtype:     None
+        """
+        if digest == self._written:
+            return
+        self.append(encode({"WRITTEN": digest}))
+        self._written = digest
+
+    def since(self, sequence: int) -> Optional[List[Dict[str, Any]]]:
+        """
+        Gets the messages published after a sequence number
+
+        :param      sequence:  The sequence number
+        :type       sequence:  int
+
+        :returns:   the messages, None if some were compacted
+        :rtype:     List[Dict[str, Any]], optional
+        """
+        with self._lock:
+            if sequence < self._base or self._file is None:
+                return None
+            self._file.flush()
+            with open(self._path, 'rb') as file:
+                data = file.read(self._file.tell())
+        messages = []
+        pos = 0
+        while pos < len(data):
+            size, = _SIZE.unpack_from(data, pos)
+            message = decode(data[pos + _SIZE.size:pos + _SIZE.size + size])
+            pos += _SIZE.size + size
+            if "SEQ" in message and message["SEQ"] > sequence:
+                messages.append(message)
+        return messages
+
+    def compact(self, keys: SshKeyDict, epoch: str, sequence: int) -> None:
+        """
+        Replace the snapshot by the keys and empty the journal
+
+        :param      keys:      The keys after the message sequence
+        :type       keys:      SshKeyDict
+        :param      epoch:     The epoch
+        :type       epoch:     str
+        :param      sequence:  The sequence number
+        :type       sequence:  int
+
+        :returns:   None
+        :rtype:     None
+        """
+        directory = os.path.dirname(os.path.abspath(self._snapshot))
+        descriptor, temporary = tempfile.mkstemp(dir=directory,
+                                                 prefix=".snapshot-")
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                file.write(encode({"EPOCH": epoch, "SEQ": sequence,
+                                   "HASH": keys.version,
+                                   "WRITTEN": self._written,
+                                   "SNAPSHOT": keys}))
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, self._snapshot)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+        with self._lock:
+            self._open(sequence, truncate=True)
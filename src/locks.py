@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# @Author: Ultraxime
+# @Date:   2026-10-18 13:05:51
+# @Last Modified by:   Ultraxime
+# @Last Modified time: 2026-10-18 13:05:51
+
+"""Module providing the lock shared by the readers of the keys"""
+
+from contextlib import contextmanager
+from threading import Condition
+from typing import Iterator
+
+
+class ReadWriteLock:
+    """
+    Lock held either by any number of readers or by a single writer.
+    Waiting writers go first, so a stream of reads cannot starve them.
+    The lock is not reentrant.
+    """
+    _condition: Condition
+    _readers: int
+    _writing: bool
+    _waiting: int
+
+    def __init__(self) -> None:
+        self._condition = Condition()
+        self._readers = 0
+        self._writing = False
+        self._waiting = 0
+
+    @contextmanager
+    def read(self) -> Iterator[None]:
+        """
+        Hold the lock as a reader for the duration of the with block
+
+        :returns:   None
+        :rtype:     Iterator[None]
+        """
+        with self._condition:
+            while self._writing or self._waiting:
+                self._condition.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def write(self) -> Iterator[None]:
+        """
+        Hold the lock as the writer for the duration of the with block
+
+        :returns:   None
+        :rtype:     Iterator[None]
+        """
+        with self._condition:
+            self._waiting += 1
+            while self._writing or self._readers:
+                self._condition.wait()
+            self._waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
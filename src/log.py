@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+# @Author: Ultraxime
+# @Date:   2026-10-18 16:21:47
+# @Last Modified by:   Ultraxime
+# @Last Modified time: 2026-10-18 16:21:47
+
+"""Module use to configure the logs of the manager and the workers"""
+
+import json
+import logging
+import sys
+
+from .config import Config
+
+# Attributes of every LogRecord, the other ones come from extra=
+_STANDARD = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None)))
+_STANDARD |= {"message", "asctime"}
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Format the records as one JSON object per line, with the fields given
+    in extra= next to the message
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"time": self.formatTime(record),
+                 "level": record.levelname,
+                 "logger": record.name,
+                 "message": record.getMessage()}
+        for name, value in vars(record).items():
+            if name not in _STANDARD and not name.startswith("_"):
+                entry[name] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+def configure(config: Config) -> None:
+    """
+    Configure the root logger from the log.level and log.format entries
+
+    :param      config:  The config
+    :type       config:  Config
+
+    :returns:   None
+    :rtype:     None
+    """
+    handler = logging.StreamHandler(sys.stdout)
+    if config.get("log.format", "json") == "json":
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(
+            "%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    root = logging.getLogger()
+    for previous in list(root.handlers):
+        root.removeHandler(previous)
+    root.addHandler(handler)
+    root.setLevel(str(config.get("log.level", "INFO")).upper())
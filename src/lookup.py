@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+# @Author: Ultraxime
+# @Date:   2026-10-18 17:40:03
+# @Last Modified by:   Ultraxime
+# @Last Modified time: 2026-10-18 17:40:03
+
+"""
+Module use to answer the AuthorizedKeysCommand of sshd from the keys held
+by the worker, over a local unix socket
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import socket
+import socketserver
+import sys
+from threading import Lock, Thread
+from typing import (Callable, Dict, Iterable, List, Optional, TextIO,
+                    Tuple)
+
+from .config import Config
+from .ssh_keys import SshKey, SshKeyDict
+
+_LOGGER = logging.getLogger(__name__)
+
+# Bound of the size of a request, a user name and a fingerprint
+MAX_REQUEST = 4096
+
+
+class KeyIndex:
+    """
+    Index of the lines of authorized_key, by fingerprint and by name of the
+    groups containing them, updated at each flush with the changed key
+    paths while the lookup server reads it
+    """
+    __slots__ = ("_lines", "_fingerprints", "_groups", "_lock")
+    # path -> (line, fingerprint)
+    _lines: Dict[str, Tuple[str, str]]
+    # fingerprint -> path -> (group names of the path, line)
+    _fingerprints: Dict[str, Dict[str, Tuple[frozenset, str]]]
+    # group name -> path -> line of the keys under a group of this name
+    _groups: Dict[str, Dict[str, str]]
+    _lock: Lock
+
+    def __init__(self, keys: SshKeyDict) -> None:
+        self._lines = {}
+        self._fingerprints = {}
+        self._groups = {}
+        self._lock = Lock()
+        for path in keys.list_key():
+            ssh_key = keys.find(path)
+            assert isinstance(ssh_key, SshKey)
+            self._add(path, ssh_key)
+
+    def _add(self, path: str, ssh_key: SshKey) -> None:
+        line = str(ssh_key)
+        groups = frozenset(path.split("/")[:-1])
+        self._lines[path] = (line, ssh_key.fingerprint)
+        self._fingerprints.setdefault(ssh_key.fingerprint, {})[path] = (
+            groups, line)
+        for group in groups:
+            self._groups.setdefault(group, {})[path] = line
+
+    def _remove(self, path: str) -> None:
+        entry = self._lines.pop(path, None)
+        if entry is None:
+            return
+        by_path = self._fingerprints[entry[1]]
+        del by_path[path]
+        if not by_path:
+            del self._fingerprints[entry[1]]
+        for group in frozenset(path.split("/")[:-1]):
+            lines = self._groups[group]
+            del lines[path]
+            if not lines:
+                del self._groups[group]
+
+    def update(self, keys: SshKeyDict, paths: Iterable[str]) -> None:
+        """
+        Updates the lines of the key paths from the keys, after they were
+        added or removed
+
+        :param      keys:   The keys
+        :type       keys:   SshKeyDict
+        :param      paths:  The paths of the changed keys
+        :type       paths:  Iterable[str]
+
+        :returns:   None
+        :rtype:     None
+        """
+        with self._lock:
+            for path in paths:
+                self._remove(path)
+                ssh_key = keys.find(path)
+                if isinstance(ssh_key, SshKey):
+                    self._add(path, ssh_key)
+
+    def lookup(self, user: Optional[str] = None,
+               fingerprint: Optional[str] = None) -> List[str]:
+        """
+        Gets the lines matching the user and the fingerprint
+
+        :param      user:         Only the keys under a group of this name
+        :type       user:         str, optional
+        :param      fingerprint:  Only the keys with this fingerprint
+        :type       fingerprint:  str, optional
+
+        :returns:   the lines
+        :rtype:     List[str]
+        """
+        with self._lock:
+            if fingerprint is not None:
+                return [line for groups, line
+                        in self._fingerprints.get(fingerprint, {}).values()
+                        if user is None or user in groups]
+            if user is not None:
+                return list(self._groups.get(user, {}).values())
+            return [line for line, _ in self._lines.values()]
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = self.rfile.readline(MAX_REQUEST).decode("utf-8", "replace")
+        words = request.split()
+        user = words[0] if words else None
+        fingerprint = words[1] if len(words) > 1 and words[1] != "-" \
+            else None
+        lines = self.server.lookup(user, fingerprint)  # type: ignore
+        self.wfile.write("".join(line + "\n" for line in lines)
+                         .encode("utf-8"))
+
+
+class _Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    lookup: Callable[[Optional[str], Optional[str]], List[str]]
+
+
+class LookupServer(Thread):
+    """
+    Thread answering the requests "USER [FINGERPRINT]\\n" on a unix socket
+    with the matching lines of authorized_key
+    """
+    _server: _Server
+
+    def __init__(self, path: str,
+                 lookup: Callable[[Optional[str], Optional[str]], List[str]],
+                 *args, **kwargs) -> None:
+        super().__init__(*args, daemon=True, **kwargs)
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        self._server = _Server(path, _Handler)
+        self._server.lookup = lookup
+        # The public keys are not secret and sshd runs the command as
+        # AuthorizedKeysCommandUser
+        os.chmod(path, 0o666)
+
+    def run(self):
+        self._server.serve_forever()
+
+
+def query(path: str, user: str, fingerprint: Optional[str] = None,
+          timeout: float = 0.5) -> Optional[str]:
+    """
+    Ask the worker listening on path for the keys of a user
+
+    :param      path:         The path of the unix socket
+    :type       path:         str
+    :param      user:         The user
+    :type       user:         str
+    :param      fingerprint:  The fingerprint of the key offered
+    :type       fingerprint:  str, optional
+    :param      timeout:      The timeout in seconds
+    :type       timeout:      float
+
+    :returns:   the lines, None if the worker did not answer
+    :rtype:     str, optional
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            sock.sendall((user + " " + (fingerprint or "-") + "\n")
+                         .encode("utf-8"))
+            chunks = []
+            while chunk := sock.recv(65536):
+                chunks.append(chunk)
+    except OSError:
+        return None
+    return b"".join(chunks).decode("utf-8")
+
+
+def authorized_keys(config: Config, user: str,
+                    fingerprint: Optional[str] = None,
+                    out: TextIO = sys.stdout) -> int:
+    """
+    Print the keys of a user for the AuthorizedKeysCommand of sshd, from
+    the worker or from its file if it does not answer
+
+    :param      config:       The config of the worker
+    :type       config:       Config
+    :param      user:         The user
+    :type       user:         str
+    :param      fingerprint:  The fingerprint of the key offered
+    :type       fingerprint:  str, optional
+    :param      out:          Where to print the keys
+    :type       out:          TextIO
+
+    :returns:   the exit status
+    :rtype:     int
+    """
+    by_user = bool(config.get("lookup.by_user", False))
+    path = config.get("lookup.socket", None)
+    answer = None
+    if path is not None:
+        answer = query(path, user, fingerprint,
+                       float(config.get("lookup.timeout", 0.5)))
+    if answer is None:
+        try:
+            keys = SshKeyDict.open(config.get("files.keys"))
+        except (OSError, ValueError):
+            return 1
+        answer = "".join(line + "\n" for line in KeyIndex(keys).lookup(
+            user if by_user else None, fingerprint))
+    out.write(answer)
+    return 0
@@ -6,108 +6,956 @@
 from __future__ import annotations
 
 
-from threading import Thread
+import asyncio
+import bisect
+import logging
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from threading import Lock, Thread
+from typing import (Any, ContextManager, Deque, Dict, List, Optional, Set,
+                    Tuple, Union)
 from zmq import Context, Socket
 import zmq
+import zmq.asyncio
 
+from . import metrics
 from .config import Config
-from .ssh_keys import SshKeyDict
+from .journal import Journal
+from .locks import ReadWriteLock
+from .persistence import WriteBehind
+from .metrics import (DECODE_SECONDS, DIFF_SECONDS, MESSAGE_BYTES,
+                      PARSE_SECONDS)
+from .protocol import ProtocolError, decode, encode, serve_catch_ups
+from .ssh_keys import SshKey, SshKeyDict, file_digest
+from .validation import Validator
+from .watch import Watcher
+
+
+DEFAULT_CONFIG = "manager-config.yml"
+
+
+# Headers of the control messages
+READS = ("LIST", "FIND", "LOOKUP", "NODES")
+MUTATIONS = ("ADD", "DEL", "BATCH")
+# Options of LIST asking for the multipart answer of _list
+LIST_OPTIONS = ("KEYS", "PAGE", "AFTER")
+# What ADD does with a key already present at another path
+DUPLICATES = ("allow", "reject", "merge")
+
+_LOGGER = logging.getLogger(__name__)
+
+REQUEST_SECONDS = metrics.histogram(
+    "ssh_manager_request_seconds",
+    "Time to answer a control request, by operation.")
+PUBLISHED = metrics.counter("ssh_manager_published_total",
+                            "Messages published to the workers, by kind.")
+SEQUENCE = metrics.gauge("ssh_manager_sequence",
+                         "Sequence number of the last published message.")
+CATCH_UPS = metrics.counter("ssh_manager_catch_up_total",
+                            "Catch up requests answered, by kind of answer.")
+PROPAGATION_SECONDS = metrics.histogram(
+    "ssh_manager_propagation_seconds",
+    "Time from the publication of a message to its acknowledgement by a"
+    " worker.")
+PROPAGATION_QUANTILES = metrics.gauge(
+    "ssh_manager_propagation_quantile_seconds",
+    "Quantiles of the last propagation times, by quantile.")
+NODE_LAG = metrics.gauge("ssh_manager_node_lag",
+                         "Messages published but not acknowledged, by node.")
+
+# Quantiles of the propagation times reported by NODES
+QUANTILES = (0.5, 0.9, 0.99)
 
 
 class Listener(Thread):
+    # Serves the control socket: reads run concurrently in the default
+    # executor, mutations go one at a time through a single writer task.
     _manager: Manager
+    _mutations: asyncio.Queue
+    _writer: ThreadPoolExecutor
+    _writer_task: Optional[asyncio.Task]
 
     def __init__(self, manager: Manager, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
         self._manager = manager
+        self._writer_task = None
+
+    def serving(self) -> bool:
+        # The thread runs and so does its writer task, once created
+        return self.is_alive() and (self._writer_task is None
+                                    or not self._writer_task.done())
 
     def run(self):
-        config = Config()
-        context = Context()
-        socket = context.socket(zmq.REP)
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        config = self._manager.config
+        context = zmq.asyncio.Context()
+        socket = context.socket(zmq.ROUTER)
         socket.bind("tcp://*:" + str(config.get("sockets.discord.port")))
+        self._mutations = asyncio.Queue()
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._writer_task = asyncio.create_task(self._write(socket))
+        tasks = {self._writer_task}
         while True: # not self.is_closed():
-            print("Waiting for message.")
-            msg = socket.recv_pyobj()
-            print("Recv: ")
-            print(msg)
-            if isinstance(msg, dict):
-                for key, value in msg.items():
-                    if not isinstance(key, str):
-                        socket.send_pyobj("FAIL")
-                    else:
-                        match key:
-                            case "ADD":
-                                if isinstance(value, SshKeyDict):
-                                    if self._manager.add_key(value):
-                                        socket.send_pyobj("ACK")
-                                    else:
-                                        socket.send_pyobj("FAIL")
-                                else:
-                                    socket.send_pyobj("FAIL")
-                                    assert isinstance(value, SshKeyDict)
-                            case "DEL":
-                                if isinstance(value, str):
-                                    if self._manager.del_key(value):
-                                        socket.send_pyobj("ACK")
-                                    else:
-                                        socket.send_pyobj("FAIL")
-                                else:
-                                    socket.send_pyobj("FAIL")
-                                    assert isinstance(value, str)
-                            case _:
-                                socket.send_pyobj("FAIL")
-                                raise ValueError(key + " is not a expect value for header of a message.")
-            elif isinstance(msg, str):
-                if msg == "LIST":
-                    socket.send_pyobj({"LIST": self._manager.list_key()})
-                else:
-                    socket.send_pyobj("FAIL")
+            frames = await socket.recv_multipart()
+            envelope = frames[:-1]
+            MESSAGE_BYTES.observe(len(frames[-1]), socket="control",
+                                  direction="in")
+            try:
+                with DECODE_SECONDS.time():
+                    msg = decode(frames[-1])
+            except ProtocolError as error:
+                _LOGGER.warning("Invalid control message: %s", error)
+                await self._reply(socket, envelope, {"ERROR": str(error)})
+                continue
+            # The other entries of a message are options of its header
+            if isinstance(msg, str):
+                header, value, options = msg, None, {}
+            elif isinstance(msg, dict) and len(msg) > 0:
+                headers = [key for key in msg
+                           if key in READS or key in MUTATIONS] or list(msg)
+                if len(headers) != 1:
+                    await self._reply(socket, envelope,
+                                      {"ERROR": "Expected a single header."})
+                    continue
+                header, value, options = headers[0], msg[headers[0]], msg
+            else:
+                await self._reply(socket, envelope,
+                                  {"ERROR": "Expected a single header."})
+                continue
+            _LOGGER.debug("Control request", extra={
+                "header": header, "bytes": len(frames[-1])})
+            if header in MUTATIONS:
+                await self._mutations.put((envelope, header, value, options))
+            elif header in READS:
+                task = asyncio.create_task(
+                    self._read(socket, envelope, header, value, options))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            else:
+                await self._reply(socket, envelope,
+                                  {"ERROR": str(header) + " is not a expect"
+                                   " value for header of a message."})
+
+    @staticmethod
+    async def _reply(socket, envelope: List[bytes], reply: Any) -> None:
+        # A list of frames is sent as one multipart message
+        if isinstance(reply, list):
+            frames = reply
+        else:
+            frames = [reply if isinstance(reply, bytes) else encode(reply)]
+        MESSAGE_BYTES.observe(sum(len(frame) for frame in frames),
+                              socket="control", direction="out")
+        await socket.send_multipart(envelope + frames)
+
+    async def _read(self, socket, envelope: List[bytes], header: str,
+                    value: Any, options: Dict[str, Any]) -> None:
+        loop = asyncio.get_running_loop()
+        with REQUEST_SECONDS.time(operation=header):
+            try:
+                reply = await loop.run_in_executor(None, self._answer,
+                                                   header, value, options)
+            except Exception as error:  # pylint: disable=W0703
+                _LOGGER.exception("Failed to answer %s.", header)
+                reply = {"ERROR": str(error)}
+        await self._reply(socket, envelope, reply)
+
+    async def _write(self, socket) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            envelope, header, value, options = await self._mutations.get()
+            with REQUEST_SECONDS.time(operation=header):
+                try:
+                    reply = await loop.run_in_executor(
+                        self._writer, self._apply, header, value, options)
+                except Exception as error:  # pylint: disable=W0703
+                    _LOGGER.exception("Failed to apply %s.", header)
+                    reply = {"ERROR": str(error)}
+            await self._reply(socket, envelope, reply)
+
+    def _answer(self, header: str, value: Any,
+                options: Dict[str, Any]) -> Union[bytes, List[bytes]]:
+        with self._manager.reading():
+            match header:
+                case "LIST":
+                    if value is None and not any(
+                            option in options for option in LIST_OPTIONS):
+                        return self._manager.encode(
+                            {"LIST": self._manager.list_key()})
+                    return self._list(value, options)
+                case "FIND":
+                    if not isinstance(value, str) or value == "":
+                        return encode("FAIL")
+                    return self._manager.encode(
+                        {"FIND": self._manager.find_key(value)})
+                case "NODES":
+                    return encode({"NODES": self._manager.nodes(),
+                                   "PROPAGATION":
+                                       self._manager.propagation()})
+                case "LOOKUP":
+                    try:
+                        key = (SshKey.convert(value)
+                               if isinstance(value, str)
+                               and not value.startswith("SHA256:")
+                               else value)
+                        if not isinstance(key, (str, SshKey)):
+                            return encode("FAIL")
+                        return encode(
+                            {"LOOKUP": self._manager.lookup_key(key)})
+                    except ValueError:
+                        return encode("FAIL")
+        return encode("FAIL")
+
+    def _list(self, pattern: Any, options: Dict[str, Any]) -> List[bytes]:
+        # A first frame with the number of paths and the cursor of the next
+        # page, then the paths, or the keys, in chunks of list.chunk_size
+        keys = options.get("KEYS", True)
+        page = options.get("PAGE")
+        after = options.get("AFTER")
+        if (not isinstance(pattern, (str, type(None)))
+                or not isinstance(keys, bool)
+                or not (page is None or isinstance(page, int) and page > 0)
+                or not isinstance(after, (str, type(None)))):
+            return [encode("FAIL")]
+        paths = self._manager.select_key(pattern or "")
+        if after is not None:
+            paths = paths[bisect.bisect_right(paths, after):]
+        cursor = None
+        if page is not None and len(paths) > page:
+            paths = paths[:page]
+            cursor = paths[-1]
+        size = int(self._manager.config.get("list.chunk_size", 1000))
+        frames = [encode({"LIST": len(paths), "NEXT": cursor})]
+        for index in range(0, len(paths), size):
+            chunk = paths[index:index + size]
+            frames.append(self._manager.encode(
+                SshKeyDict({path: found for path in chunk
+                            if (found := self._manager.find_key(path))
+                            is not None}) if keys else chunk))
+        return frames
+
+    def _apply(self, header: str, value: Any, options: Dict[str, Any]) -> Any:
+        match header:
+            case "ADD":
+                duplicates = options.get("DUPLICATES")
+                if (isinstance(value, SshKeyDict)
+                        and duplicates in DUPLICATES + (None,)):
+                    errors = self._manager.validate(value)
+                    if errors:
+                        return {"INVALID": errors}
+                    if self._manager.add_key(value, duplicates):
+                        return "ACK"
+            case "DEL":
+                if isinstance(value, str) and self._manager.del_key(value):
+                    return "ACK"
+            case "BATCH":
+                if isinstance(value, list):
+                    # The keys of all the additions are checked at once
+                    indexes = [index for index, operation in enumerate(value)
+                               if isinstance(operation, dict)
+                               and isinstance(operation.get("ADD"),
+                                              SshKeyDict)]
+                    invalid: List[Dict[str, str]] = [{} for _ in value]
+                    for index, errors in zip(
+                            indexes, self._manager.validate_all(
+                                [value[index]["ADD"] for index in indexes])):
+                        invalid[index] = errors
+                    if any(invalid):
+                        return {"INVALID": invalid}
+                    applied, results = self._manager.batch(value)
+                    return {"ACK" if applied else "FAIL": results}
+        return "FAIL"
+
+
+def _quantiles(values: List[float]) -> Dict[str, float]:
+    # Nearest rank quantiles of sorted values
+    if not values:
+        return {}
+    return {str(quantile): values[min(int(quantile * len(values)),
+                                      len(values) - 1)]
+            for quantile in QUANTILES}
+
+
+def _valid(path: str) -> bool:
+    return path != "" and all(path.split("/"))
+
+
+def _group_paths(tree: SshKeyDict) -> List[str]:
+    # Relative paths of all the groups of a tree
+    found = []
+    todo = [("", tree)]
+    while todo:
+        prefix, group = todo.pop()
+        for name, value in group.items():
+            if isinstance(value, SshKeyDict):
+                found.append(prefix + name)
+                todo.append((prefix + name + "/", value))
+    return found
+
+
+def _touched(operation: Any,
+             keys: SshKeyDict) -> Tuple[List[str], Set[str]]:
+    # Paths of the keys an operation can change, and of the entries it
+    # can turn into a group without entries or out of one, with all their
+    # parents
+    if not isinstance(operation, dict):
+        return [], set()
+    paths: List[str] = []
+    spots: List[str] = []
+    for header, value in operation.items():
+        if header == "ADD" and isinstance(value, SshKeyDict):
+            paths.extend(value.list_key())
+            spots.extend(value.list_key())
+            spots.extend(_group_paths(value))
+        elif header == "DEL" and isinstance(value, str):
+            paths.append(value)
+            spots.append(value)
+        elif (header == "MOVE" and isinstance(value, list)
+              and len(value) == 2
+              and all(isinstance(path, str) and _valid(path)
+                      for path in value)):
+            spots.extend(value)
+            moved = keys.find(value[0])
+            if not isinstance(moved, SshKeyDict):
+                paths.extend(value)
+                continue
+            for prefix in value:
+                paths.extend(prefix + "/" + path
+                             for path in moved.list_key())
+                spots.extend(prefix + "/" + path
+                             for path in _group_paths(moved))
+    groups: Set[str] = set()
+    for path in spots:
+        if not _valid(path):
+            continue
+        index = path.find("/")
+        while index != -1:
+            groups.add(path[:index])
+            index = path.find("/", index + 1)
+        groups.add(path)
+    return [path for path in paths if _valid(path)], groups
+
+
+class Snapshot(Thread):
+    # Answers the workers that missed deltas, as in the ZeroMQ clone pattern
+    _manager: Manager
+
+    def __init__(self, manager: Manager, *args, **kwargs) -> None:
+        super().__init__(*args, daemon=True, **kwargs)
+        self._manager = manager
+
+    def run(self):
+        config = self._manager.config
+        context = Context()
+        socket = context.socket(zmq.ROUTER)
+        socket.bind("tcp://*:" + str(config.get("sockets.snapshot.port")))
+        serve_catch_ups(socket, self._answer)
+
+    def _answer(self, since: Optional[int], epoch: Any,
+                digests: Optional[Dict[str, bytes]], _: bytes) -> bytes:
+        with REQUEST_SECONDS.time(operation="SINCE"):
+            try:
+                reply = self._manager.catch_up(since, epoch, digests)
+            except Exception as error:  # pylint: disable=W0703
+                _LOGGER.exception("Failed to answer a catch up.")
+                reply = encode({"ERROR": str(error)})
+        MESSAGE_BYTES.observe(len(reply), socket="snapshot", direction="out")
+        return reply
+
+
+class Acks(Thread):
+    # Receives the sequence numbers written by the workers
+    _manager: Manager
+
+    def __init__(self, manager: Manager, *args, **kwargs) -> None:
+        super().__init__(*args, daemon=True, **kwargs)
+        self._manager = manager
+
+    def run(self):
+        config = self._manager.config
+        context = Context()
+        socket = context.socket(zmq.PULL)
+        socket.bind("tcp://*:" + str(config.get("sockets.ack.port")))
+        while True:
+            data = socket.recv()
+            MESSAGE_BYTES.observe(len(data), socket="ack", direction="in")
+            try:
+                msg = decode(data)
+            except ProtocolError as error:
+                _LOGGER.warning("Invalid acknowledgement: %s", error)
+                continue
+            if (isinstance(msg, dict) and isinstance(msg.get("NODE"), str)
+                    and isinstance(msg.get("SEQ"), int)):
+                self._manager.acknowledge(msg["NODE"], msg.get("EPOCH"),
+                                          msg["SEQ"], msg.get("HASH"),
+                                          msg.get("DELAY"))
+
+
+class Heartbeat(Thread):
+    # Publishes the last sequence number every interval seconds
+    _manager: Manager
+    _interval: float
+
+    def __init__(self, manager: Manager, interval: float,
+                 *args, **kwargs) -> None:
+        super().__init__(*args, daemon=True, **kwargs)
+        self._manager = manager
+        self._interval = interval
+
+    @property
+    def interval(self) -> float:
+        return self._interval
+
+    def run(self):
+        while True:
+            time.sleep(self._interval)
+            self._manager.heartbeat()
 
 
 class Manager:
+    # pylint: disable=R0902,R0904
+    # Holds the state of every thread and socket of the manager, which all
+    # call back into it
+    config: Config
     _listener: Listener
+    _snapshot: Snapshot
+    _acks: Acks
+    # None if heartbeat.interval is null
+    _heartbeat: Optional[Heartbeat]
     _socket: Socket
+    _keys: SshKeyDict
+    _lock: ReadWriteLock
+    _writer: WriteBehind
+    # Published messages, replayed to know what the workers have
+    _journal: Journal
+    # Size of the journal from which it is compacted in a snapshot
+    _compact_size: int
+    # What must be published before the first delta: None when the workers
+    # are assumed up to date, else the difference with the journal and the
+    # version it leads to, or the whole tree if there is no journal.
+    _pending: Optional[Tuple[Dict[str, Union[SshKeyDict, List[str]]], str]]
+    # Changes with the current epoch as EPOCH. Each published message
+    # carries its SEQ number and the HASH of the tree once it is applied.
+    _epoch: str
+    _sequence: int
+    _log: Deque[Dict[str, Any]]
+    # Default value of the DUPLICATES option of ADD
+    _duplicates: str
+    # Method, threshold and level of the compression of large messages
+    _compression: Tuple[Optional[str], int, Optional[int]]
+    # Used by the writer thread of the listener only
+    _validator: Validator
+    # Digest of the file when last read by the manager, to tell apart its
+    # own writes and the changes made by hand
+    _seen: Optional[bytes]
+    # (SEQ, time) of the last published messages, the last acknowledgement
+    # of each node and the last propagation times, under _acks_lock
+    _published: Deque[Tuple[int, float]]
+    _nodes: Dict[str, Dict[str, Any]]
+    _propagation: Deque[float]
+    _acks_lock: Lock
 
-    def __init__(self):
+    def __init__(self, config: Optional[Config] = None):
+        self.config = config or Config.shared(default=DEFAULT_CONFIG)
         self._listener = Listener(self)
-        config = Config()
+        self._snapshot = Snapshot(self)
+        self._acks = Acks(self)
+        config = self.config
+        interval = config.get("heartbeat.interval", None)
+        self._heartbeat = (Heartbeat(self, float(interval))
+                           if interval is not None else None)
+        filename = config.get("files.keys")
+        self._published = deque(maxlen=int(config.get("sync.log_size")))
+        self._nodes = {}
+        self._propagation = deque(maxlen=int(config.get("acks.window")))
+        self._acks_lock = Lock()
+        self._journal = Journal(config.get("files.journal"),
+                                config.get("files.snapshot"),
+                                bool(config.get("journal.fsync")))
+        self._compact_size = int(config.get("journal.compact_size"))
+        self._log = deque(maxlen=int(config.get("sync.log_size")))
+        with PARSE_SECONDS.time():
+            epoch, sequence, saved, messages = self._journal.recover()
+        self._seen = file_digest(filename)
+        if saved is not None:
+            # The journal holds every acknowledged change, the file may be
+            # a copy older than it or have been edited by hand meanwhile
+            self._keys = saved
+            self._pending = None
+            if (self._seen is not None
+                    and self._seen != self._journal.written):
+                self._recover_file(filename, {saved.version, *(
+                    message["HASH"] for message in messages)})
+        else:
+            try:
+                with PARSE_SECONDS.time():
+                    self._keys = SshKeyDict.open(filename)
+            except FileNotFoundError:
+                # An empty tree would delete every key of the workers,
+                # after a lost file or a wrong mount
+                if not config.get("files.allow_missing", False):
+                    raise FileNotFoundError(
+                        "Neither " + str(filename) + " nor the journal"
+                        " exist, set files.allow_missing to start without"
+                        " keys.") from None
+                self._keys = SshKeyDict({})
+            if config.get("files.save", None) is not None:
+                # Save file of the versions before the journal
+                try:
+                    with PARSE_SECONDS.time():
+                        saved = SshKeyDict.open(config.get("files.save"))
+                except FileNotFoundError:
+                    pass
+            if saved is None:
+                self._pending = ({"UPDATE": self._keys}, self._keys.version)
+            else:
+                with DIFF_SECONDS.time():
+                    self._pending = (
+                        (self._keys.diff(saved), self._keys.version)
+                        if saved.version != self._keys.version else None)
+        # Workers up to date with the journal need nothing after a restart
+        self._epoch = epoch or uuid.uuid4().hex
+        self._sequence = sequence
+        self._log.extend(messages)
+        # Bound once the keys are loaded, a refused start leaves no socket
         context = Context()
         self._socket = context.socket(zmq.PUB)
         self._socket.bind("tcp://*:" + str(config.get("sockets.worker.port")))
+        self._lock = ReadWriteLock()
+        self._writer = WriteBehind(self._keys, self._lock, [filename],
+                                   config.get("persistence.delay"),
+                                   journal=self._journal)
+        self._duplicates = config.get("keys.duplicates")
+        self._compression = (config.get("compression.method", None),
+                             int(config.get("compression.threshold", 0)),
+                             config.get("compression.level", None))
+        self._validator = Validator(
+            int(config.get("validation.rsa_min_bits")),
+            int(config.get("validation.rsa_max_bits")),
+            config.get("validation.processes", None),
+            int(config.get("validation.parallel_threshold")),
+            int(config.get("validation.cache_size")))
 
-    def start(self):
+    def start(self, daemon: bool = False):
+        metrics.add_check(self.health)
+        metrics.serve(self.config.get("metrics.port", None))
+        self._writer.start()
+        # The file may be older than the journal
+        self._writer.touch()
+        # The workers get the changes found at the start before the first
+        # heartbeat, whose digest would not match them otherwise
+        with self._lock.write():
+            self._publish_pending()
+        self._snapshot.start()
+        self._acks.start()
+        if self._heartbeat is not None:
+            self._heartbeat.start()
+        if self.config.get("watch.enabled", False):
+            Watcher(self.config.get("files.keys"), self.reload,
+                    debounce=float(self.config.get("watch.debounce")),
+                    max_delay=float(self.config.get("watch.max_delay")),
+                    interval=float(self.config.get("watch.interval"))
+                    ).start()
+        self._listener.daemon = daemon
         self._listener.start()
 
-    def add_key(self, dic: SshKeyDict) -> bool:
-        old_dict = self.list_key()
-        if old_dict.add(dic):
-            old_dict.write()
-            self.update()
-            return True
-        return False
+    def close(self) -> None:
+        # Releases the publisher of a manager whose threads were not
+        # started, its context blocks the exit otherwise
+        self._socket.close(linger=0)
+
+    @property
+    def sequence(self) -> int:
+        return self._sequence
+
+    def health(self) -> List[str]:
+        # Problems reported by /health of the metrics server
+        problems = [name + " thread is dead." for name, thread
+                    in (("The snapshot", self._snapshot),
+                        ("The acknowledgement", self._acks),
+                        ("The heartbeat", self._heartbeat),
+                        ("The writer", self._writer))
+                    if thread is not None and not thread.is_alive()]
+        if self._writer.error is not None:
+            problems.append("Writing the keys fails: " + self._writer.error)
+        if not self._listener.serving():
+            problems.append("The listener or its writer task is dead.")
+        return problems
+
+    def acknowledge(self, node: str, epoch: Optional[str], sequence: int,
+                    version: Optional[str], delay: Optional[float]) -> None:
+        # Each message acknowledged since the previous acknowledgement of
+        # the node gives its propagation time, from its publication to now.
+        # The first one of a node may come from a catch up at its start.
+        now = time.monotonic()
+        with self._acks_lock:
+            last = self._nodes.get(node)
+            self._nodes[node] = {"EPOCH": epoch, "SEQ": sequence,
+                                 "HASH": version, "DELAY": delay,
+                                 "TIME": time.time()}
+            if (epoch == self._epoch and last is not None
+                    and last["EPOCH"] == epoch):
+                for published, when in self._published:
+                    if last["SEQ"] < published <= sequence:
+                        PROPAGATION_SECONDS.observe(now - when)
+                        self._propagation.append(now - when)
+            propagation = sorted(self._propagation)
+        if epoch == self._epoch:
+            NODE_LAG.set(self._sequence - sequence, node=node)
+            for quantile, value in _quantiles(propagation).items():
+                PROPAGATION_QUANTILES.set(value, quantile=quantile)
+
+    def nodes(self) -> Dict[str, Dict[str, Any]]:
+        # Last acknowledgement of each node, with LAG in messages
+        with self._acks_lock:
+            return {node: dict(state, LAG=(self._sequence - state["SEQ"]
+                                           if state["EPOCH"] == self._epoch
+                                           else None))
+                    for node, state in self._nodes.items()}
+
+    def propagation(self) -> Dict[str, float]:
+        with self._acks_lock:
+            return _quantiles(sorted(self._propagation))
+
+    def add_key(self, dic: SshKeyDict,
+                duplicates: Optional[str] = None) -> bool:
+        with self._lock.write():
+            added = self._deduplicate(dic, duplicates)
+            if added is None or not self._keys.add(added):
+                return False
+            if len(added) > 0:
+                self.update({"ADD": added})
+        self._writer.touch()
+        return True
 
     def del_key(self, key_name: str) -> bool:
-        old_dict = self.list_key()
-        if old_dict.remove(key_name):
-            old_dict.write()
-            self.update()
-            return True
+        with self._lock.write():
+            if not self._keys.remove(key_name):
+                return False
+            self.update({"DEL": [key_name]})
+        self._writer.touch()
+        return True
+
+    def batch(self, operations: List[Any]) -> Tuple[bool, List[str]]:
+        # Applies all the operations or none of them, with a single publish
+        # and write. The key at each path an operation can change is saved
+        # before its first change, so that a failure can restore it and the
+        # delta only compares these paths. So is whether each group around
+        # them had no entries, the delta cannot remove such a group.
+        with self._lock.write():
+            saved: Dict[str, Optional[SshKey]] = {}
+            empty: Dict[str, bool] = {}
+            results = []
+            for operation in operations:
+                paths, groups = _touched(operation, self._keys)
+                for path in paths:
+                    if path not in saved:
+                        saved[path] = self._key_at(path)
+                for path in groups:
+                    if path not in empty:
+                        empty[path] = self._empty_at(path)
+                try:
+                    applied = self._operate(operation)
+                except Exception:  # pylint: disable=W0703
+                    # Rolled back with the others
+                    _LOGGER.exception("Failed to apply a batch operation.")
+                    applied = False
+                results.append("ACK" if applied else "FAIL")
+            changed = {path: self._key_at(path)
+                       for path, ssh_key in saved.items()
+                       if self._key_at(path) != ssh_key}
+            if "FAIL" in results:
+                self._restore(saved, changed, empty)
+                return False, results
+            deleted = [path for path in changed
+                       if saved[path] is not None]
+            added = SshKeyDict({path: ssh_key
+                                for path, ssh_key in changed.items()
+                                if ssh_key is not None})
+            # The workers remove a group without entries only when they
+            # add something in it
+            created = [path for path, was_empty in empty.items()
+                       if not was_empty and self._empty_at(path)]
+            for path in created:
+                added.add(SshKeyDict({path: SshKeyDict({})}))
+            if any(was_empty and not self._empty_at(path)
+                   and not any(other.startswith(path + "/")
+                               for other in chain(added.list_key(), created))
+                   for path, was_empty in empty.items()):
+                self._pending = None
+                self.full_update(self._keys)
+            elif deleted or len(added) > 0:
+                self.update({"DEL": deleted, "ADD": added})
+        self._writer.touch()
+        return True, results
+
+    def _restore(self, saved: Dict[str, Optional[SshKey]],
+                 changed: Dict[str, Optional[SshKey]],
+                 empty: Dict[str, bool]) -> None:
+        # Undoes a batch from what it saved. The keys it added are removed
+        # and so are the groups without entries it left, the deepest first,
+        # before a key can stand again where one of them was.
+        for path, ssh_key in changed.items():
+            if ssh_key is not None:
+                self._keys.remove(path)
+        for path in sorted(empty, key=lambda path: -path.count("/")):
+            if not empty[path] and self._empty_at(path):
+                parent, _, name = path.rpartition("/")
+                group = self._keys.find(parent) if parent else self._keys
+                assert isinstance(group, SshKeyDict)
+                del group[name]
+        for path, ssh_key in saved.items():
+            if path in changed and ssh_key is not None:
+                self._keys.add(SshKeyDict({path: ssh_key}))
+        for path, was_empty in empty.items():
+            if was_empty and self._keys.find(path) is None:
+                self._keys.add(SshKeyDict({path: SshKeyDict({})}))
+
+    def _key_at(self, path: str) -> Optional[SshKey]:
+        found = self._keys.find(path)
+        return found if isinstance(found, SshKey) else None
+
+    def _empty_at(self, path: str) -> bool:
+        found = self._keys.find(path)
+        return isinstance(found, SshKeyDict) and len(found) == 0
+
+    def reload(self) -> bool:
+        # Publishes the changes made by hand to the file. Its digest is
+        # checked first, the writes of the manager and the saves without
+        # change are not parsed.
+        filename = self.config.get("files.keys")
+        digest = file_digest(filename)
+        if digest is None or digest in (self._seen,
+                                        self._writer.written(filename)):
+            return False
+        self._seen = digest
+        try:
+            with PARSE_SECONDS.time():
+                keys = SshKeyDict.open(filename)
+        except ValueError as error:
+            _LOGGER.error("Cannot read the edited keys: %s", error)
+            return False
+        with self._lock.write():
+            if keys == self._keys:
+                return False
+            delta = self._replace(keys)
+            if delta is not None:
+                self.update(delta)
+            else:
+                self._pending = None
+                self.full_update(self._keys)
+        _LOGGER.info("Published the changes made to the file.",
+                     extra={"full": delta is None})
+        return True
+
+    def _recover_file(self, filename: str, versions: Set[str]) -> None:
+        # At start, the changes made by hand to the file while the manager
+        # was down are applied to the keys of the journal and published
+        # first. A copy of keys it recorded is only older than the journal.
+        try:
+            with PARSE_SECONDS.time():
+                keys = SshKeyDict.open(filename)
+        except ValueError as error:
+            _LOGGER.error("Cannot read the edited keys: %s", error)
+            return
+        if keys.version in versions:
+            return
+        delta = self._replace(keys)
+        self._pending = ((delta if delta is not None
+                          else {"UPDATE": self._keys}), self._keys.version)
+        _LOGGER.info("Found changes made to the file while stopped.",
+                     extra={"full": delta is None})
+
+    def _replace(self, keys: SshKeyDict
+                 ) -> Optional[Dict[str, Union[SshKeyDict, List[str]]]]:
+        # Makes the keys equal to these ones, in place as the writer holds
+        # them, and gives the delta, None if only a full update can
+        # express it
+        with DIFF_SECONDS.time():
+            delta = keys.diff(self._keys)
+        deleted = delta["DEL"]
+        added = delta["ADD"]
+        assert isinstance(deleted, list) and isinstance(added, SshKeyDict)
+        for key_name in deleted:
+            self._keys.remove(key_name)
+        if self._keys.add(added) and self._keys == keys:
+            return delta
+        # The diff does not carry empty groups
+        self._keys.clear()
+        self._keys.add(keys)
+        return None
+
+    def _operate(self, operation: Any) -> bool:
+        if not isinstance(operation, dict) or len(operation) != 1:
+            return False
+        header, value = next(iter(operation.items()))
+        match header:
+            case "ADD":
+                if not isinstance(value, SshKeyDict):
+                    return False
+                value = self._deduplicate(value, None)
+                return value is not None and self._keys.add(value)
+            case "DEL":
+                return isinstance(value, str) and self._keys.remove(value)
+            case "MOVE":
+                if (not isinstance(value, list) or len(value) != 2
+                        or not all(isinstance(path, str) and _valid(path)
+                                   for path in value)):
+                    return False
+                source, destination = value
+                moved = self._keys.find(source)
+                if (moved is None or destination in self._keys
+                        or destination.startswith(source + "/")
+                        or not self._keys.add(
+                            SshKeyDict({destination: moved}))):
+                    return False
+                if isinstance(moved, SshKey):
+                    return self._keys.remove(source)
+                # The groups left empty go away, as with remove()
+                path = source
+                while True:
+                    path, _, name = path.rpartition("/")
+                    parent = self._keys.find(path) if path else self._keys
+                    assert isinstance(parent, SshKeyDict)
+                    del parent[name]
+                    if not path or len(parent) > 0:
+                        return True
         return False
 
+    def _deduplicate(self, dic: SshKeyDict,
+                     duplicates: Optional[str]) -> Optional[SshKeyDict]:
+        # dic without the keys already in the tree under another path, or
+        # None if they must be rejected
+        duplicates = duplicates or self._duplicates
+        if duplicates == "allow":
+            return dic
+        found = self._keys.duplicates(dic)
+        if not found:
+            return dic
+        if duplicates == "reject":
+            return None
+        dic = dic.copy()
+        for path in found:
+            dic.remove(path)
+        return dic
+
+    def validate(self, dic: SshKeyDict) -> Dict[str, str]:
+        return self._validator.validate(dic)
+
+    def validate_all(self, dics: List[SshKeyDict]) -> List[Dict[str, str]]:
+        return self._validator.validate_all(dics)
+
     def list_key(self) -> SshKeyDict:
-        return SshKeyDict.open()
+        return self._keys
+
+    def lookup_key(self, key: Union[SshKey, str]) -> List[str]:
+        return self._keys.paths_of(key)
+
+    def find_key(self, path: str) -> Optional[Union[SshKey, SshKeyDict]]:
+        return self._keys.find(path)
+
+    def select_key(self, pattern: str) -> List[str]:
+        # Sorted, so that the pages of a listing follow each other
+        return sorted(self._keys.select(pattern))
+
+    def encode(self, message: Any) -> bytes:
+        return encode(message, *self._compression)
+
+    def reading(self) -> ContextManager[None]:
+        return self._lock.read()
 
     def full_update(self, new_dict: SshKeyDict):
-        new_dict.write("/authorized_key.save")
-        self._socket.send_pyobj({"UPDATE": new_dict})
+        # Nothing older than a full update is needed to catch up
+        self._log.clear()
+        self.publish({"UPDATE": new_dict}, new_dict.version)
+        self._journal.compact(new_dict, self._epoch, self._sequence)
 
-    def update(self):
-        new_dict = SshKeyDict.open()
-        try:
-            old_dict = SshKeyDict.open("/authorized_key.save")
-        except FileNotFoundError:
-            self.full_update(new_dict)
+    def update(self, delta: Dict[str, Union[SshKeyDict, List[str]]]):
+        # Must be called with the lock held, right after the change
+        if self._publish_pending():
             return
-        new_dict.write("/authorized_key.save")
-        self._socket.send_pyobj(new_dict.diff(old_dict))
+        self.publish(delta, self._keys.version)
+        if self._journal.size >= self._compact_size:
+            self._journal.compact(self._keys, self._epoch, self._sequence)
+
+    def _publish_pending(self) -> bool:
+        # Publishes the changes found at the start, with the lock held.
+        # True when it took a full update, which already holds the keys.
+        if self._pending is None:
+            return False
+        pending, version = self._pending
+        self._pending = None
+        if "UPDATE" in pending:
+            self.full_update(self._keys)
+            return True
+        self.publish(pending, version)
+        return False
+
+    def publish(self, delta: Dict[str, Any], version: str):
+        self._sequence += 1
+        message = dict(delta, EPOCH=self._epoch, SEQ=self._sequence,
+                       HASH=version)
+        data = self.encode(message)
+        with self._acks_lock:
+            self._published.append((self._sequence, time.monotonic()))
+        if "UPDATE" not in message:
+            self._log.append(message)
+            self._journal.append(data)
+        self._socket.send(data)
+        kind = "UPDATE" if "UPDATE" in message else "DELTA"
+        PUBLISHED.inc(kind=kind)
+        MESSAGE_BYTES.observe(len(data), socket="publish", direction="out")
+        SEQUENCE.set(self._sequence)
+        _LOGGER.info("Published", extra={"kind": kind, "seq": self._sequence,
+                                         "bytes": len(data)})
+
+    def heartbeat(self) -> None:
+        # The workers which missed the last deltas notice it without waiting
+        # for the next one, the ones whose keys differ at the same sequence
+        # number by the digest, and the ones cut off from the manager hear
+        # nothing. The lock keeps the publish socket to one thread.
+        with self._lock.read():
+            data = self.encode({"HEARTBEAT": self._sequence,
+                                "EPOCH": self._epoch,
+                                "HASH": self._keys.version})
+            self._socket.send(data)
+        MESSAGE_BYTES.observe(len(data), socket="publish", direction="out")
+
+    def catch_up(self, since: Optional[int], epoch: Optional[str],
+                 digests: Optional[Dict[str, bytes]] = None) -> bytes:
+        # The deltas published after since if they are all still in the
+        # log or the journal, else the top level entries differing from
+        # the digests of the worker, or a snapshot of the whole tree.
+        # The workers skip their silence check without heartbeats
+        interval = (self._heartbeat.interval if self._heartbeat is not None
+                    else None)
+        with self._lock.read():
+            reply = {"EPOCH": self._epoch, "SEQ": self._sequence,
+                     "INTERVAL": interval}
+            # since if it is a sequence number published in this epoch
+            known = (since if since is not None and epoch == self._epoch
+                     and since <= self._sequence else None)
+            if known is not None and (known == self._sequence or (
+                    self._log and self._log[0]["SEQ"] <= known + 1)):
+                CATCH_UPS.inc(kind="DELTAS")
+                return self.encode(dict(reply, DELTAS=[
+                    message for message in self._log
+                    if message["SEQ"] > known]))
+            messages = (self._journal.since(known) if known is not None
+                        else None)
+            if messages is not None:
+                CATCH_UPS.inc(kind="JOURNAL")
+                return self.encode(dict(reply, DELTAS=messages))
+            if digests is not None:
+                deleted, added = self._keys.patch(digests)
+                CATCH_UPS.inc(kind="PATCH" if deleted or added else "SAME")
+                return self.encode(dict(reply, HASH=self._keys.version,
+                                        PATCH={"DEL": deleted,
+                                               "ADD": added}))
+            CATCH_UPS.inc(kind="SNAPSHOT")
+            return self.encode(dict(reply, HASH=self._keys.version,
+                                    SNAPSHOT=self._keys))
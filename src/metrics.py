@@ -0,0 +1,400 @@
+# -*- coding: utf-8 -*-
+# @Author: Ultraxime
+# @Date:   2026-10-18 16:05:12
+# @Last Modified by:   Ultraxime
+# @Last Modified time: 2026-10-18 16:05:12
+
+"""Module use to measure the manager and the workers"""
+
+from __future__ import annotations
+
+import bisect
+import sys
+import time
+import urllib.error
+import urllib.request
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Callable, Dict, Iterator, List, Optional, TextIO, Tuple
+
+# Bounds in seconds of the buckets of the duration histograms
+DURATIONS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0,
+             10.0)
+# Bounds in bytes of the buckets of the size histograms
+SIZES = (64, 256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+         16777216, 67108864)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Dict[str, object]) -> Labels:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format(labels: Labels, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = labels + ((extra,) if extra is not None else ())
+    if not pairs:
+        return ""
+    return "{" + ",".join(name + '="' + value.replace("\\", "\\\\")
+                          .replace('"', '\\"').replace("\n", "\\n") + '"'
+                          for name, value in pairs) + "}"
+
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Base class of the metrics, a value for each set of labels
+    """
+    kind = "untyped"
+    name: str
+    help: str
+    _lock: Lock
+
+    def __init__(self, name: str, help_text: str) -> None:
+        self.name = name
+        self.help = help_text
+        self._lock = Lock()
+
+    def samples(self) -> Iterator[str]:
+        """
+        Iterate on the lines of the metric in the Prometheus text format
+
+        :returns:   the lines
+        :rtype:     Iterator[str]
+        """
+        raise NotImplementedError
+
+    def render(self) -> str:
+        """
+        Render the metric in the Prometheus text format
+
+        :returns:   the text
+        :rtype:     str
+        """
+        with self._lock:
+            lines = list(self.samples())
+        return "\n".join(["# HELP " + self.name + " " + self.help,
+                          "# TYPE " + self.name + " " + self.kind] + lines)
+
+
+class Counter(Metric):
+    """
+    Value that only goes up
+    """
+    kind = "counter"
+    _values: Dict[Labels, float]
+
+    def __init__(self, name: str, help_text: str) -> None:
+        super().__init__(name, help_text)
+        self._values = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        """
+        Increase the value
+
+        :param      amount:  The amount
+        :type       amount:  float
+        :param      labels:  The labels of the value
+
+        :returns:   None
+        :rtype:     None
+        """
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[str]:
+        for labels, value in self._values.items():
+            yield self.name + _format(labels) + " " + _number(value)
+
+
+class Gauge(Counter):
+    """
+    Value that can be set
+    """
+    kind = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        """
+        Set the value
+
+        :param      value:   The value
+        :type       value:   float
+        :param      labels:  The labels of the value
+
+        :returns:   None
+        :rtype:     None
+        """
+        key = _labels(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """
+    Count of the observed values in buckets, with their sum
+    """
+    kind = "histogram"
+    _bounds: Tuple[float, ...]
+    _values: Dict[Labels, Tuple[List[int], List[float]]]
+
+    def __init__(self, name: str, help_text: str,
+                 bounds: Tuple[float, ...] = DURATIONS) -> None:
+        super().__init__(name, help_text)
+        self._bounds = bounds
+        self._values = {}
+
+    def observe(self, value: float, **labels) -> None:
+        """
+        Add a value
+
+        :param      value:   The value
+        :type       value:   float
+        :param      labels:  The labels of the value
+
+        :returns:   None
+        :rtype:     None
+        """
+        key = _labels(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = ([0] * (len(self._bounds) + 1), [0.0])
+            buckets, total = self._values[key]
+            buckets[bisect.bisect_left(self._bounds, value)] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        """
+        Observe the duration in seconds of the with block
+
+        :param      labels:  The labels of the value
+
+        :returns:   the context manager
+        :rtype:     ContextManager[None]
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterator[str]:
+        for labels, (buckets, total) in self._values.items():
+            count = 0
+            for bound, number in zip(self._bounds + (float("inf"),),
+                                     buckets):
+                count += number
+                yield (self.name + "_bucket"
+                       + _format(labels, ("le", _number(float(bound))))
+                       + " " + str(count))
+            yield self.name + "_sum" + _format(labels) + " " + repr(total[0])
+            yield self.name + "_count" + _format(labels) + " " + str(count)
+
+
+class Registry:
+    """
+    Metrics of the process
+    """
+    _metrics: Dict[str, Metric]
+    _lock: Lock
+
+    def __init__(self) -> None:
+        self._metrics = {}
+        self._lock = Lock()
+
+    def register(self, metric: Metric) -> Metric:
+        """
+        Add a metric, or get the one registered with the same name
+
+        :param      metric:  The metric
+        :type       metric:  Metric
+
+        :returns:   the registered metric
+        :rtype:     Metric
+        """
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        """
+        Render every metric in the Prometheus text format
+
+        :returns:   the text
+        :rtype:     str
+        """
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return "".join(metric.render() + "\n" for metric in metrics)
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, help_text: str) -> Counter:
+    """
+    Gets the counter of this name in REGISTRY
+
+    :param      name:       The name
+    :type       name:       str
+    :param      help_text:  The description
+    :type       help_text:  str
+
+    :returns:   the counter
+    :rtype:     Counter
+    """
+    metric = REGISTRY.register(Counter(name, help_text))
+    assert isinstance(metric, Counter)
+    return metric
+
+
+def gauge(name: str, help_text: str) -> Gauge:
+    """
+    Gets the gauge of this name in REGISTRY
+
+    :param      name:       The name
+    :type       name:       str
+    :param      help_text:  The description
+    :type       help_text:  str
+
+    :returns:   the gauge
+    :rtype:     Gauge
+    """
+    metric = REGISTRY.register(Gauge(name, help_text))
+    assert isinstance(metric, Gauge)
+    return metric
+
+
+def histogram(name: str, help_text: str,
+              bounds: Tuple[float, ...] = DURATIONS) -> Histogram:
+    """
+    Gets the histogram of this name in REGISTRY
+
+    :param      name:       The name
+    :type       name:       str
+    :param      help_text:  The description
+    :type       help_text:  str
+    :param      bounds:     The upper bounds of the buckets
+    :type       bounds:     Tuple[float, ...]
+
+    :returns:   the histogram
+    :rtype:     Histogram
+    """
+    metric = REGISTRY.register(Histogram(name, help_text, bounds))
+    assert isinstance(metric, Histogram)
+    return metric
+
+
+# Checks of the health of the process, each gives its problems
+_CHECKS: List[Callable[[], List[str]]] = []
+
+
+def add_check(check: Callable[[], List[str]]) -> None:
+    """
+    Add a check to the answer of /health
+
+    :param      check:  Gives the problems found, none when healthy
+    :type       check:  Callable[[], List[str]]
+
+    :returns:   None
+    :rtype:     None
+    """
+    _CHECKS.append(check)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):  # pylint: disable=invalid-name
+        path = self.path.split("?")[0]
+        if path == "/health":
+            problems = [problem for check in list(_CHECKS)
+                        for problem in check()]
+            body = "".join(problem + "\n" for problem in problems or ["ok"]
+                           ).encode("utf-8")
+            self.send_response(503 if problems else 200)
+            self.send_header("Content-Type", "text/plain; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type",
+                         "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+        pass
+
+
+def serve(port: Optional[int], address: str = "") -> Optional[Thread]:
+    """
+    Serve REGISTRY over HTTP for Prometheus, in a daemon thread
+
+    :param      port:     The port, None to not serve the metrics
+    :type       port:     int, optional
+    :param      address:  The address to listen on, every one by default
+    :type       address:  str
+
+    :returns:   the thread serving the metrics
+    :rtype:     Thread, optional
+    """
+    if port is None:
+        return None
+    server = ThreadingHTTPServer((address, int(port)), _Handler)
+    server.daemon_threads = True
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return thread
+
+
+def healthcheck(port: Optional[int], timeout: float = 2.0,
+                out: TextIO = sys.stderr) -> int:
+    """
+    Ask the process serving the metrics on port about its health
+
+    :param      port:     The port, None when the metrics are not served
+    :type       port:     int, optional
+    :param      timeout:  The timeout in seconds
+    :type       timeout:  float
+    :param      out:      Where to print the problems
+    :type       out:      TextIO
+
+    :returns:   the exit status, 0 if healthy or nothing to ask
+    :rtype:     int
+    """
+    if port is None:
+        return 0
+    try:
+        with urllib.request.urlopen("http://127.0.0.1:" + str(port)
+                                    + "/health", timeout=timeout):
+            return 0
+    except urllib.error.HTTPError as error:
+        out.write(error.read().decode("utf-8", "replace"))
+    except OSError as error:
+        out.write(str(error) + "\n")
+    return 1
+
+
+# Measures shared by the manager and the workers
+MESSAGE_BYTES = histogram("ssh_manager_message_bytes",
+                          "Size of the messages by socket and direction.",
+                          SIZES)
+DECODE_SECONDS = histogram("ssh_manager_decode_seconds",
+                           "Time to decode a received message.")
+PARSE_SECONDS = histogram("ssh_manager_parse_seconds",
+                          "Time to parse an authorized_key file.")
+WRITE_SECONDS = histogram("ssh_manager_write_seconds",
+                          "Time to write the keys to a file.")
+DIFF_SECONDS = histogram("ssh_manager_diff_seconds",
+                         "Time to compute the difference of two trees.")
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+# @Author: Ultraxime
+# @Date:   2026-10-18 10:12:40
+# @Last Modified by:   Ultraxime
+# @Last Modified time: 2026-10-18 10:12:40
+
+"""Module use to save the in memory ssh keys to disk"""
+
+from __future__ import annotations
+
+import logging
+import time
+from threading import Event, Thread
+from typing import Dict, List, Optional
+
+from .journal import Journal
+from .locks import ReadWriteLock
+from .metrics import WRITE_SECONDS
+from .ssh_keys import SshKeyDict, file_digest
+
+_LOGGER = logging.getLogger(__name__)
+
+# Seconds before retrying a failed write, doubled after each failure
+RETRY = 1.0
+MAX_RETRY = 60.0
+
+
+class WriteBehind(Thread):
+    """
+    Thread writing a SshKeyDict to its files some time after a change, so
+    that a burst of modifications ends up in a single write. The digest
+    of the first file is recorded in the journal, if given.
+    """
+    _keys: SshKeyDict
+    _lock: ReadWriteLock
+    _filenames: List[str]
+    _delay: float
+    _dirty: Event
+    # Digest of the content last written to each file
+    _written: Dict[str, Optional[bytes]]
+    _journal: Optional[Journal]
+    # Error of the last write, None once a write succeeds
+    _error: Optional[str]
+
+    def __init__(self, keys: SshKeyDict, lock: ReadWriteLock,
+                 filenames: List[str], delay: float, *args,
+                 journal: Optional[Journal] = None, **kwargs) -> None:
+        super().__init__(*args, daemon=True, **kwargs)
+        self._keys = keys
+        self._lock = lock
+        self._filenames = filenames
+        self._delay = delay
+        self._dirty = Event()
+        self._written = {}
+        self._journal = journal
+        self._error = None
+
+    def touch(self) -> None:
+        """
+        Mark the keys as modified, they will be written after the delay
+
+        :returns:   None
+        :rtype:     None
+        """
+        self._dirty.set()
+
+    def written(self, filename: str) -> Optional[bytes]:
+        """
+        Gets the digest of the content last written to a file
+
+        :param      filename:  The filename
+        :type       filename:  str
+
+        :returns:   the digest, None before the first write
+        :rtype:     bytes, optional
+        """
+        return self._written.get(filename)
+
+    @property
+    def error(self) -> Optional[str]:
+        """
+        Gets the error of the last write
+
+        :returns:   the error, None if the last write succeeded
+        :rtype:     str, optional
+        """
+        return self._error
+
+    def run(self):
+        retry = RETRY
+        while True:
+            self._dirty.wait()
+            time.sleep(self._delay)
+            try:
+                self.flush()
+            except Exception as error:  # pylint: disable=W0703
+                _LOGGER.exception("Failed to write the keys, retrying in"
+                                  " %s seconds", retry)
+                self._error = str(error) or type(error).__name__
+                self._dirty.set()
+                time.sleep(retry)
+                retry = min(2 * retry, MAX_RETRY)
+            else:
+                self._error = None
+                retry = RETRY
+
+    def flush(self) -> None:
+        """
+        Write the keys now, holding the lock as a reader
+
+        :returns:   None
+        :rtype:     None
+        """
+        with self._lock.read():
+            self._dirty.clear()
+            for filename in self._filenames:
+                with WRITE_SECONDS.time(file=filename):
+                    self._keys.write(filename)
+                digest = file_digest(filename)
+                self._written[filename] = digest
+                if (self._journal is not None and digest is not None
+                        and filename == self._filenames[0]):
+                    self._journal.mark_written(digest)
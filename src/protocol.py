@@ -0,0 +1,383 @@
+# -*- coding: utf-8 -*-
+# @Author: Ultraxime
+# @Date:   2026-10-18 11:02:17
+# @Last Modified by:   Ultraxime
+# @Last Modified time: 2026-10-18 11:02:17
+
+"""Module defining the messages exchanged between the manager and workers"""
+
+from __future__ import annotations
+
+import logging
+import lzma
+import struct
+import zlib
+from typing import (Any, Callable, Dict, Iterator, List, Mapping, Optional,
+                    Tuple)
+
+from zmq import Socket
+
+from .ssh_keys import KeyMode, SshKey, SshKeyDict
+
+_LOGGER = logging.getLogger(__name__)
+
+MAGIC = b"SM"
+VERSION = 3
+
+# A frame is MAGIC, VERSION, the compression flag then one value, compressed
+# if the flag says so. Each value starts with its tag, strings and bytes are
+# prefixed by their length, containers by their size.
+_RAW = 0
+_ZLIB = 1
+_LZMA = 2
+COMPRESSIONS = {"zlib": _ZLIB, "lzma": _LZMA}
+_HEADER = len(MAGIC) + 2
+# Bound of a decompressed frame, against compression bombs
+MAX_SIZE = 1 << 30
+
+_NONE = 0
+_TRUE = 1
+_FALSE = 2
+_INT = 3
+_FLOAT = 4
+_STR = 5
+_BYTES = 6
+_LIST = 7
+_DICT = 8
+_KEY = 9
+_TREE = 10
+
+_MODES = list(KeyMode)
+_SIZE = struct.Struct("<I")
+_INT64 = struct.Struct("<q")
+_FLOAT64 = struct.Struct("<d")
+_NO_COMMENT = 0xFFFFFFFF
+
+
+class ProtocolError(ValueError):
+    """
+    Raised when a received frame cannot be decoded
+    """
+
+
+def _write_str(out: bytearray, value: str) -> None:
+    data = value.encode("utf-8")
+    out += _SIZE.pack(len(data))
+    out += data
+
+
+def _items(out: bytearray, mapping: Mapping) -> Iterator[Any]:
+    # The keys are written as the values are consumed by encode()
+    for key, value in mapping.items():
+        if not isinstance(key, str):
+            raise TypeError("Only str keys can be encoded, not "
+                            + type(key).__name__)
+        _write_str(out, key)
+        yield value
+
+
+def encode(message: Any, compression: Optional[str] = None,
+           threshold: int = 0, level: Optional[int] = None) -> bytes:
+    """
+    Encode a message made of None, bool, int, float, str, bytes, list,
+    dict with str keys, SshKey and SshKeyDict.
+
+    :param      message:      The message
+    :type       message:      Any
+    :param      compression:  zlib or lzma to compress large messages
+    :type       compression:  str, optional
+    :param      threshold:    The size in bytes from which a message is
+                              compressed
+    :type       threshold:    int
+    :param      level:        The zlib level or lzma preset
+    :type       level:        int, optional
+
+    :returns:   the frame to send
+    :rtype:     bytes
+    """
+    # pylint: disable=R0912,R0915
+    # One branch per type in a single loop, a function call per value
+    # would slow down the encoding of large trees
+    if compression is not None and compression not in COMPRESSIONS:
+        raise ValueError(str(compression) + " is not a compression, expected"
+                         " one of " + ", ".join(COMPRESSIONS))
+    out = bytearray(MAGIC)
+    out.append(VERSION)
+    out.append(_RAW)
+    todo: List[Iterator[Any]] = [iter((message,))]
+    while todo:
+        for value in todo[-1]:
+            if value is None:
+                out.append(_NONE)
+            elif value is True:
+                out.append(_TRUE)
+            elif value is False:
+                out.append(_FALSE)
+            elif isinstance(value, int):
+                out.append(_INT)
+                out += _INT64.pack(value)
+            elif isinstance(value, float):
+                out.append(_FLOAT)
+                out += _FLOAT64.pack(value)
+            elif isinstance(value, str):
+                out.append(_STR)
+                _write_str(out, value)
+            elif isinstance(value, bytes):
+                out.append(_BYTES)
+                out += _SIZE.pack(len(value))
+                out += value
+            elif isinstance(value, SshKey):
+                out.append(_KEY)
+                out.append(_MODES.index(value.mode))
+                out += _SIZE.pack(len(value.blob))
+                out += value.blob
+                if value.comment is None:
+                    out += _SIZE.pack(_NO_COMMENT)
+                else:
+                    _write_str(out, value.comment)
+            elif isinstance(value, SshKeyDict):
+                out.append(_TREE)
+                out += _SIZE.pack(len(value))
+                todo.append(_items(out, value))
+                break
+            elif isinstance(value, dict):
+                out.append(_DICT)
+                out += _SIZE.pack(len(value))
+                todo.append(_items(out, value))
+                break
+            elif isinstance(value, (list, tuple)):
+                out.append(_LIST)
+                out += _SIZE.pack(len(value))
+                todo.append(iter(value))
+                break
+            else:
+                raise TypeError(type(value).__name__
+                                + " cannot be encoded in a message.")
+        else:
+            todo.pop()
+    if compression is not None and len(out) - _HEADER >= threshold:
+        body = memoryview(out)[_HEADER:]
+        if compression == "zlib":
+            packed = zlib.compress(body, -1 if level is None else level)
+        else:
+            packed = lzma.compress(body, preset=level)
+        body.release()
+        if len(packed) < len(out) - _HEADER:
+            return (MAGIC + bytes((VERSION, COMPRESSIONS[compression]))
+                    + packed)
+    return bytes(out)
+
+
+def _decompress(flag: int, data: memoryview) -> bytes:
+    if flag == _ZLIB:
+        decompressor = zlib.decompressobj()
+        body = decompressor.decompress(data, MAX_SIZE)
+        complete = decompressor.eof and not decompressor.unconsumed_tail
+    elif flag == _LZMA:
+        decompressor = lzma.LZMADecompressor()
+        body = decompressor.decompress(data, MAX_SIZE)
+        complete = decompressor.eof
+    else:
+        raise ProtocolError("Unknown compression " + str(flag) + ".")
+    if not complete:
+        raise ProtocolError("Truncated or too large compressed message.")
+    return body
+
+
+def _read_str(data: memoryview, pos: int) -> Tuple[str, int]:
+    size, = _SIZE.unpack_from(data, pos)
+    pos += _SIZE.size
+    if pos + size > len(data):
+        raise ProtocolError("Truncated string at " + str(pos))
+    return str(data[pos:pos+size], "utf-8"), pos + size
+
+
+def decode(frame: bytes) -> Any:
+    """
+    Decode a frame built by encode
+
+    :param      frame:  The frame
+    :type       frame:  bytes
+
+    :returns:   the message
+    :rtype:     Any
+    """
+    if frame[:2] != MAGIC:
+        raise ProtocolError("Not a ssh manager message.")
+    if len(frame) < _HEADER or frame[2] != VERSION:
+        raise ProtocolError("Unsupported message version.")
+    data = memoryview(frame)
+    try:
+        if frame[3] != _RAW:
+            data = memoryview(_decompress(frame[3], data[_HEADER:]))
+            return _decode(data, 0)
+        return _decode(data, _HEADER)
+    except (zlib.error, lzma.LZMAError) as error:
+        raise ProtocolError("Malformed compressed message: "
+                            + str(error)) from error
+    except (struct.error, IndexError, UnicodeDecodeError) as error:
+        raise ProtocolError("Malformed message: " + str(error)) from error
+
+
+def _store(container: Any, kind: int, name: str, value: Any) -> None:
+    if kind == _LIST:
+        container.append(value)
+    else:
+        container[name] = value
+
+
+def _decode(data: memoryview, pos: int) -> Any:
+    # pylint: disable=R0912,R0914,R0915
+    # One branch per tag in a single loop, as in encode()
+    # Stack of [container, values left, tag, parent, parent tag, name]. A
+    # container is stored in its parent once complete, so that a group is
+    # indexed in one go by its parent.
+    result: List[Any] = []
+    todo: List[List[Any]] = [[result, 1, _LIST, None, _LIST, ""]]
+    while todo:
+        container, left, kind, parent, parent_kind, parent_name = todo[-1]
+        if left == 0:
+            todo.pop()
+            if parent is not None:
+                _store(parent, parent_kind, parent_name, container)
+            continue
+        todo[-1][1] = left - 1
+        name = ""
+        if kind != _LIST:
+            name, pos = _read_str(data, pos)
+            if kind == _TREE and (not name or "/" in name):
+                raise ProtocolError("Invalid name " + repr(name)
+                                    + " in a tree at " + str(pos))
+        tag = data[pos]
+        pos += 1
+        if kind == _TREE and tag not in (_KEY, _TREE):
+            raise ProtocolError("Unexpected value in a tree at "
+                                + str(pos - 1))
+        if tag == _NONE:
+            value = None
+        elif tag == _TRUE:
+            value = True
+        elif tag == _FALSE:
+            value = False
+        elif tag == _INT:
+            value, = _INT64.unpack_from(data, pos)
+            pos += _INT64.size
+        elif tag == _FLOAT:
+            value, = _FLOAT64.unpack_from(data, pos)
+            pos += _FLOAT64.size
+        elif tag == _STR:
+            value, pos = _read_str(data, pos)
+        elif tag == _BYTES:
+            size, = _SIZE.unpack_from(data, pos)
+            pos += _SIZE.size
+            if pos + size > len(data):
+                raise ProtocolError("Truncated bytes at " + str(pos))
+            value = bytes(data[pos:pos+size])
+            pos += size
+        elif tag == _KEY:
+            mode = _MODES[data[pos]]
+            size, = _SIZE.unpack_from(data, pos + 1)
+            pos += 1 + _SIZE.size
+            if pos + size > len(data):
+                raise ProtocolError("Truncated key at " + str(pos))
+            blob = bytes(data[pos:pos+size])
+            pos += size
+            comment = None
+            if _SIZE.unpack_from(data, pos)[0] == _NO_COMMENT:
+                pos += _SIZE.size
+            else:
+                comment, pos = _read_str(data, pos)
+            value = SshKey.from_blob(mode, blob, comment)
+        elif tag in (_LIST, _DICT, _TREE):
+            size, = _SIZE.unpack_from(data, pos)
+            pos += _SIZE.size
+            todo.append([[] if tag == _LIST
+                         else {} if tag == _DICT
+                         else SshKeyDict({}),
+                         size, tag, container, kind, name])
+            continue
+        else:
+            raise ProtocolError("Unknown tag " + str(tag) + " at "
+                                + str(pos - 1))
+        _store(container, kind, name, value)
+    if pos != len(data):
+        raise ProtocolError("Trailing data after the message.")
+    return result[0]
+
+
+def send(socket: Socket, message: Any, flags: int = 0) -> None:
+    """
+    Encode and send a message on a zmq socket
+
+    :param      socket:   The socket
+    :type       socket:   Socket
+    :param      message:  The message
+    :type       message:  Any
+    :param      flags:    The zmq flags
+    :type       flags:    int
+
+    :returns:   None
+    :rtype:     None
+    """
+    socket.send(encode(message), flags)
+
+
+def recv(socket: Socket, flags: int = 0) -> Any:
+    """
+    Receive and decode a message from a zmq socket
+
+    :param      socket:  The socket
+    :type       socket:  Socket
+    :param      flags:   The zmq flags
+    :type       flags:   int
+
+    :returns:   the message
+    :rtype:     Any
+    """
+    return decode(socket.recv(flags))
+
+
+# Gives the answer to a catch up from the sequence number, epoch and top
+# level digests of the requester and the request as received, None to
+# answer nothing
+CatchUpAnswer = Callable[
+    [Optional[int], Any, Optional[Dict[str, bytes]], bytes], Optional[bytes]]
+
+
+def _digests(msg: Dict[str, Any]) -> Optional[Dict[str, bytes]]:
+    # Digests of the top level entries of the worker asking to catch up
+    digests = msg.get("DIGESTS")
+    if not isinstance(digests, dict) or not all(
+            isinstance(key, str) and isinstance(value, bytes)
+            for key, value in digests.items()):
+        return None
+    return digests
+
+
+def serve_catch_ups(socket: Socket, answer: CatchUpAnswer) -> None:
+    """
+    Answer forever the catch up requests received on a ROUTER socket, the
+    other messages are dropped
+
+    :param      socket:  The ROUTER socket
+    :type       socket:  Socket
+    :param      answer:  Gives the answer to each request
+    :type       answer:  CatchUpAnswer
+
+    :returns:   None
+    :rtype:     None
+    """
+    while True:
+        frames = socket.recv_multipart()
+        try:
+            msg = decode(frames[-1])
+        except ProtocolError as error:
+            _LOGGER.warning("Invalid catch up request: %s", error)
+            continue
+        if not isinstance(msg, dict) or "SINCE" not in msg:
+            continue
+        since = msg["SINCE"]
+        reply = answer(since if isinstance(since, int) else None,
+                       msg.get("EPOCH"), _digests(msg), frames[-1])
+        if reply is not None:
+            socket.send_multipart(frames[:-1] + [reply])
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# @Author: Ultraxime
+# @Date:   2026-10-18 19:48:26
+# @Last Modified by:   Ultraxime
+# @Last Modified time: 2026-10-18 19:48:26
+
+"""
+Module use by the workers relaying the manager to other workers, so that
+the manager only sends its messages to the relays
+"""
+
+from __future__ import annotations
+
+import logging
+from functools import partial
+from threading import Thread
+from typing import TYPE_CHECKING, Any, Dict, Optional
+
+import zmq
+from zmq import Context
+
+from . import metrics
+from .protocol import serve_catch_ups
+
+if TYPE_CHECKING:
+    from .worker import Worker
+
+_LOGGER = logging.getLogger(__name__)
+
+RELAYED_CATCH_UPS = metrics.counter(
+    "ssh_manager_relay_catch_up_total",
+    "Catch up requests of the workers below a relay, by who answered.")
+
+
+class Forwarder(Thread):
+    """
+    Thread republishing the messages of the upstream publisher to the
+    workers connected to the port, without decoding them
+    """
+    _upstream: str
+    _port: int
+
+    def __init__(self, upstream: str, port: int, *args, **kwargs) -> None:
+        super().__init__(*args, daemon=True, **kwargs)
+        self._upstream = upstream
+        self._port = port
+
+    def run(self):
+        context = Context()
+        frontend = context.socket(zmq.XSUB)
+        frontend.connect(self._upstream)
+        backend = context.socket(zmq.XPUB)
+        backend.bind("tcp://*:" + str(self._port))
+        zmq.proxy(frontend, backend)
+
+
+class AckForwarder(Thread):
+    """
+    Thread passing the acknowledgements of the workers connected to the
+    port on to the upstream ones
+    """
+    _upstream: str
+    _port: int
+
+    def __init__(self, upstream: str, port: int, *args, **kwargs) -> None:
+        super().__init__(*args, daemon=True, **kwargs)
+        self._upstream = upstream
+        self._port = port
+
+    def run(self):
+        context = Context()
+        frontend = context.socket(zmq.PULL)
+        frontend.bind("tcp://*:" + str(self._port))
+        backend = context.socket(zmq.PUSH)
+        backend.connect(self._upstream)
+        zmq.proxy(frontend, backend)
+
+
+class CatchUp(Thread):
+    """
+    Thread answering the catch up requests of the workers below a relay
+    from the keys of the relay, or from upstream when it is behind them
+    """
+    _worker: Worker
+    _upstream: str
+    _port: int
+    _timeout: float
+
+    def __init__(self, worker: Worker, upstream: str, port: int,
+                 timeout: float, *args, **kwargs) -> None:
+        super().__init__(*args, daemon=True, **kwargs)
+        self._worker = worker
+        self._upstream = upstream
+        self._port = port
+        self._timeout = timeout
+
+    def run(self):
+        context = Context()
+        socket = context.socket(zmq.ROUTER)
+        socket.bind("tcp://*:" + str(self._port))
+        serve_catch_ups(socket, partial(self._answer, context))
+
+    def _answer(self, context: Context, since: Optional[int], epoch: Any,
+                digests: Optional[Dict[str, bytes]],
+                request: bytes) -> Optional[bytes]:
+        try:
+            reply = self._worker.catch_up(since, epoch, digests)
+        except Exception:  # pylint: disable=W0703
+            # Left to the manager
+            _LOGGER.exception("Failed to answer a catch up.")
+            reply = None
+        if reply is not None:
+            RELAYED_CATCH_UPS.inc(answer="relay")
+            return reply
+        RELAYED_CATCH_UPS.inc(answer="upstream")
+        return self._ask(context, request)
+
+    def _ask(self, context: Context, request: bytes) -> Optional[bytes]:
+        upstream = context.socket(zmq.DEALER)
+        upstream.connect(self._upstream)
+        try:
+            upstream.send(request)
+            if not upstream.poll(int(self._timeout * 1000)):
+                _LOGGER.error("No answer from upstream to a relayed catch"
+                              " up request.")
+                return None
+            return upstream.recv()
+        finally:
+            upstream.close(linger=0)
@@ -6,8 +6,17 @@
 
 from __future__ import annotations
 
-from collections.abc import MutableMapping
-from typing import Optional, Union, Dict, List
+import base64
+import binascii
+import errno
+import hashlib
+import os
+import shutil
+import stat
+import tempfile
+from collections.abc import Iterator, Mapping, MutableMapping
+from fnmatch import fnmatchcase
+from typing import BinaryIO, Optional, Union, Dict, List, Set, Tuple
 from enum import Enum, auto
 
 
@@ -35,30 +44,121 @@ class KeyMode(Enum):
         return self.__repr__()
 
 
+# Names found in front of a key, the OpenSSH ones and the ones of
+# KeyMode.__repr__, written before the keys used the name in their blob.
+# The others are not added, they come from any input.
+_MODE_NAMES: Dict[str, KeyMode] = {
+    "ssh-dss": KeyMode.DSA,
+    "ecdsa-sha2-nistp256": KeyMode.ECDSA,
+    "ecdsa-sha2-nistp384": KeyMode.ECDSA,
+    "ecdsa-sha2-nistp521": KeyMode.ECDSA,
+    "sk-ecdsa-sha2-nistp256@openssh.com": KeyMode.ECDSA_SK,
+    "sk-ssh-ed25519@openssh.com": KeyMode.ED25519_SK,
+    **{repr(mode): mode for mode in KeyMode},
+}
+
+
+def _parse_mode(name: str) -> KeyMode:
+    mode = _MODE_NAMES.get(name)
+    if mode is None:
+        mode = KeyMode(name[4:])
+    return mode
+
+
 class SshKey:
     # pylint: disable=R0903
+    # Immutable, the key is kept decoded and its SHA256 computed on demand
+    __slots__ = ("_mode", "_blob", "_comment", "_hash", "_line")
     _mode: KeyMode
-    _key: str
+    _blob: bytes
     _comment: Optional[str]
+    _hash: Optional[bytes]
+    # SHA256 of the line written for the key, part of the tree digests
+    _line: Optional[bytes]
 
     def __init__(self, mode: KeyMode,
                  key: str, comment: Optional[str] = None) -> None:
-        self._mode = mode
-        i = len(key)-1
-        while i > 0 and key[i] == ' ':
-            i -= 1
-        self._key = key[:i+1]
-        if comment is not None:
-            i = len(comment)-1
-            while i > 0 and comment[i] == ' ':
-                i -= 1
-            self._comment = comment[:i+1]
-        else:
-            self._comment = None
+        try:
+            blob = base64.b64decode(key.rstrip(" "), validate=True)
+        except binascii.Error as error:
+            raise ValueError(key + " is not a valid ssh key.") from error
+        self._set(mode, blob, comment)
+
+    def _set(self, mode: KeyMode, blob: bytes,
+             comment: Optional[str]) -> None:
+        object.__setattr__(self, "_mode", mode)
+        object.__setattr__(self, "_blob", blob)
+        object.__setattr__(self, "_comment",
+                           comment.rstrip(" ") if comment is not None
+                           else None)
+        object.__setattr__(self, "_hash", None)
+        object.__setattr__(self, "_line", None)
+
+    @classmethod
+    def from_blob(cls, mode: KeyMode, blob: bytes,
+                  comment: Optional[str] = None) -> SshKey:
+        ssh_key = cls.__new__(cls)
+        ssh_key._set(mode, blob, comment)
+        return ssh_key
+
+    def __setattr__(self, name, value):
+        raise AttributeError("SshKey is immutable")
+
+    def __reduce__(self):
+        return (SshKey.from_blob, (self._mode, self._blob, self._comment))
+
+    @property
+    def mode(self) -> KeyMode:
+        return self._mode
+
+    @property
+    def blob(self) -> bytes:
+        return self._blob
+
+    @property
+    def key(self) -> str:
+        return base64.b64encode(self._blob).decode("ascii")
+
+    @property
+    def comment(self) -> Optional[str]:
+        return self._comment
+
+    @property
+    def algorithm(self) -> str:
+        # Name in front of the key for sshd, the first string of the blob,
+        # or the one of the mode for a blob not starting with one
+        if len(self._blob) >= 4:
+            size = int.from_bytes(self._blob[:4], "big")
+            if 0 < size <= len(self._blob) - 4:
+                try:
+                    return self._blob[4:4 + size].decode("ascii")
+                except UnicodeDecodeError:
+                    pass
+        return str(self._mode)
+
+    @property
+    def fingerprint(self) -> str:
+        # Same format as ssh-keygen -l
+        return "SHA256:" + base64.b64encode(
+            self.digest()).decode("ascii").rstrip("=")
+
+    def digest(self) -> bytes:
+        if self._hash is None:
+            object.__setattr__(self, "_hash",
+                               hashlib.sha256(self._blob).digest())
+        assert self._hash is not None
+        return self._hash
+
+    def line_digest(self) -> bytes:
+        if self._line is None:
+            object.__setattr__(self, "_line", hashlib.sha256(
+                str(self).encode("utf-8")).digest())
+        assert self._line is not None
+        return self._line
 
     def __repr__(self) -> str:
-        return (str(self._mode) + " "
-                + self._key
+        return (self.algorithm + " "
+                + self.key
                 + ((" " + self._comment) if self._comment is not None else ""))
 
     def __str__(self) -> str:
@@ -66,25 +166,22 @@ class SshKey:
 
     @classmethod
     def convert(cls, value: str) -> SshKey:
-        args = value.split(" ")
+        args = value.split(" ", 2)
         if len(args) < 2:
             raise ValueError(value + " is not a valid ssh key.")
-        mode = KeyMode(args[0][4:])
-        key = args[1]
-        comment = ""
-        for word in args[2:]:
-            comment += word + " "
-        if comment == "":
-            comment = None
-        return cls(mode, key, comment)
+        mode = _parse_mode(args[0])
+        comment = args[2] if len(args) > 2 and args[2].strip(" ") else None
+        return cls(mode, args[1], comment)
 
-    def __eq__(self, other: SshKey):
-        return (self._mode == other._mode             # pylint: disable=W0212
-                and self._key == other._key           # pylint: disable=W0212
-                and self._comment == other._comment)  # pylint: disable=W0212
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, SshKey):
+            return NotImplemented
+        return (self._mode is other._mode           # pylint: disable=W0212
+                and self._comment == other._comment  # pylint: disable=W0212
+                and self.digest() == other.digest())
 
-    def __ne__(self, other: SshKey):
-        return not self.__eq__(other)
+    def __hash__(self) -> int:
+        return hash(self.digest())
 
 
 try:
@@ -99,55 +196,181 @@ try:
                 await ctx.respond(arg + " is not a valid ssh key.")
                 raise ValueError(arg + " is not a valid ssh key.")
             try:
-                mode = KeyMode(args[0][4:])
+                mode = _parse_mode(args[0])
             except ValueError:
                 await ctx.respond(
                     args[0][4:]
                     + " is not a valid mode for a ssh key.")
                 raise
-            key = args[1]
-            comment = ""
-            for word in args[2:]:
-                comment += word + " "
-            if comment == "":
-                comment = None
-            return SshKey(mode, key, comment)
+            return SshKey(mode, args[1], " ".join(args[2:]) or None)
 except ModuleNotFoundError:
     pass
 
 
+# realpath -> ((mtime, size), sha256) of the files read or written
+_DIGESTS: Dict[str, Tuple[Tuple[int, int], bytes]] = {}
+
+
+def _stamp(status: os.stat_result) -> Tuple[int, int]:
+    return (status.st_mtime_ns, status.st_size)
+
+
+def file_digest(filename: str) -> Optional[bytes]:
+    """
+    SHA256 of the content of a file, read again only when its modification
+    time or size changed since the last call or write of SshKeyDict
+
+    :param      filename:  The filename
+    :type       filename:  str
+
+    :returns:   the digest, None if there is no such file
+    :rtype:     bytes, optional
+    """
+    path = os.path.realpath(filename)
+    try:
+        stamp = _stamp(os.stat(path))
+    except FileNotFoundError:
+        return None
+    if path in _DIGESTS and _DIGESTS[path][0] == stamp:
+        return _DIGESTS[path][1]
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 16), b""):
+            digest.update(chunk)
+    _DIGESTS[path] = (stamp, digest.digest())
+    return digest.digest()
+
+
+# Read once, os.umask can only be read by setting it for every thread
+_UMASK = os.umask(0o022)
+os.umask(_UMASK)
+
+
+def _replace(source: str, filename: str) -> None:
+    try:
+        status = os.stat(filename)
+    except FileNotFoundError:
+        status = None
+    if status is None:
+        # mkstemp makes it private, sshd reads it as the user logging in
+        os.chmod(source, 0o666 & ~_UMASK)
+    else:
+        os.chmod(source, stat.S_IMODE(status.st_mode))
+        try:
+            os.chown(source, status.st_uid, status.st_gid)
+        except PermissionError:
+            pass
+    try:
+        os.replace(source, filename)
+    except OSError as error:
+        # A bind mounted file cannot be renamed over, copy the content in
+        # place instead. docker-compose.yml mounts a directory to avoid it.
+        if error.errno not in (errno.EBUSY, errno.EXDEV):
+            raise
+        with open(source, "rb") as src, open(filename, "r+b") as dst:
+            shutil.copyfileobj(src, dst)
+            dst.truncate()
+            dst.flush()
+            os.fsync(dst.fileno())
+        return
+    descriptor = os.open(os.path.dirname(os.path.abspath(filename)),
+                         os.O_RDONLY)
+    try:
+        os.fsync(descriptor)
+    finally:
+        os.close(descriptor)
+
+
+def _join(path: str, name: str) -> str:
+    return path + "/" + name if path else name
+
+
+def _entry_digest(value: Union[SshKey, SshKeyDict]) -> bytes:
+    # Part of the digest of a group for one of its entries
+    if isinstance(value, SshKeyDict):
+        return b"G" + value.digest()
+    return b"K" + value.line_digest()
+
+
+# The terms of the entries of a group are summed modulo 2 ** 512
+_MODULUS = 1 << 512
+
+
+def _term(name: str, entry: bytes) -> int:
+    # Share of an entry in the digest of its group, summed with the others
+    # so that a change only hashes the entries it touches
+    encoded = name.encode("utf-8")
+    return int.from_bytes(hashlib.sha512(
+        len(encoded).to_bytes(4, "big") + encoded + entry).digest(), "big")
+
+
+def _check_group(name: str, number: int) -> None:
+    # A group without a name would have the path of its parent
+    if name == "":
+        raise ValueError("Line " + str(number) + ": invalid name ''.")
+
+
 class SshKeyDict(MutableMapping):
+    # pylint: disable=W0212
+    # The groups of a tree update the indexes and digests of each other
     _content: Dict[str, Union[SshKeyDict, SshKey]]
-
-    def __init__(self, dic: Dict[str, Union[Dict, SshKey]]):
+    _parent: Optional[SshKeyDict]
+    _name: str
+    # Every key and group of the tree by path. Only kept by the root, None
+    # for a group in a tree, and for a new or detached one until asked.
+    _index: Optional[Dict[str, Union[SshKey, SshKeyDict]]]
+    # Number of keys in the subtree, updated up to the root on each
+    # mutation
+    _count: int
+    # SHA256 of a key -> paths holding it, in insertion order. Only kept
+    # by the root, None for a group in a tree or detached from it until
+    # it is asked again.
+    _fingerprints: Optional[Dict[bytes, Dict[str, None]]]
+    _listing: Optional[List[str]]
+    # Hash of the subtree content, independent of the insertion order
+    _digest: Optional[bytes]
+    # Sum of the terms of the entries, the ones of the groups as of their
+    # last digest, and the groups whose digest changed since
+    _sum: int
+    _terms: Dict[str, int]
+    _stale: Set[str]
+
+    def __init__(self, dic: Mapping[str, Union[Mapping, SshKey]]):
         self._content = {}
+        self._parent = None
+        self._name = ""
+        self._index = None
+        self._count = 0
+        self._fingerprints = None
+        self._listing = None
+        self._digest = None
+        self._sum = 0
+        self._terms = {}
+        self._stale = set()
         for full_key, value in dic.items():
             key = full_key.split('/')[0]
             if key != full_key:
                 value = {full_key[len(key)+1:]: value}
+            group = self._content.get(key)
             if isinstance(value, SshKey):
-                self._content[key] = value
+                self[key] = value
+            elif isinstance(group, SshKeyDict):
+                group.add(SshKeyDict(value))
             else:
-                self._content[key] = SshKeyDict(value)
+                self[key] = SshKeyDict(value)
 
     def __contains__(self, full_key: str) -> bool:
         if full_key == "":
             raise KeyError("Empty keys are not allowed")
-
-        key = full_key.split("/")[0]
-        if key == full_key:
-            return key in self._content
-
-        remaining_key = full_key[len(key)+1:]
-        if key in self._content:
-            next_content = self[key]
-            if isinstance(next_content, SshKeyDict):
-                return remaining_key in next_content
-        return False
+        return self.find(full_key) is not None
 
     def __len__(self) -> int:
         return len(self._content)
 
+    def key_count(self) -> int:
+        # Number of keys in the whole tree
+        return self._count
+
     def __getitem__(self, key: str) -> Union[SshKey, SshKeyDict]:
         return self._content[key]
 
@@ -155,101 +378,437 @@ class SshKeyDict(MutableMapping):
         return iter(self._content)
 
     def __setitem__(self, key: str, value: Union[SshKey, SshKeyDict]):
+        if key in self._content:
+            old_value = self._content[key]
+            self._reindex(key, old_value, False)
+            if isinstance(old_value, SshKeyDict):
+                old_value._parent = None
+        if isinstance(value, SshKeyDict):
+            if value._parent is not None:
+                value = value.copy()
+            value._parent = self
+            value._name = key
+            value._index = None
+            value._fingerprints = None
         self._content[key] = value
+        self._reindex(key, value, True)
 
     def __delitem__(self, key: str) -> None:
-        self._content.__delitem__(key)
+        value = self._content.pop(key)
+        self._reindex(key, value, False)
+        if isinstance(value, SshKeyDict):
+            value._parent = None
+
+    def _entries(self) -> Iterator[Tuple[str, Union[SshKey, SshKeyDict]]]:
+        # Every key and group of the subtree with its path relative to self
+        todo: List[Tuple[str, SshKeyDict]] = [("", self)]
+        while todo:
+            prefix, group = todo.pop()
+            for name, value in group._content.items():
+                yield prefix + name, value
+                if isinstance(value, SshKeyDict):
+                    todo.append((prefix + name + "/", value))
+
+    def _root(self) -> Tuple[SshKeyDict, str]:
+        # The root of the tree and the path of self in it, with a trailing
+        # slash
+        root = self
+        prefix = ""
+        while root._parent is not None:
+            prefix = root._name + "/" + prefix
+            root = root._parent
+        return root, prefix
+
+    def _paths(self) -> Tuple[Dict[str, Union[SshKey, SshKeyDict]], str]:
+        # The index of the root, built aside if needed so that a concurrent
+        # reader does not see it partial, and the path of self in it
+        root, prefix = self._root()
+        index = root._index
+        if index is None:
+            index = dict(root._entries())
+            root._index = index
+        return index, prefix
+
+    def _reindex(self, key: str, value: Union[SshKey, SshKeyDict],
+                 insert: bool) -> None:
+        if isinstance(value, SshKey):
+            term = _term(key, _entry_digest(value))
+            self._sum = (self._sum + (term if insert else -term)) % _MODULUS
+            count = 1
+        else:
+            if insert:
+                self._stale.add(key)
+            else:
+                self._sum = (self._sum - self._terms.pop(key, 0)) % _MODULUS
+                self._stale.discard(key)
+            count = value._count
+        node = self
+        prefix = ""
+        while True:
+            node._count += count if insert else -count
+            node._listing = None
+            node._digest = None
+            if node._parent is None:
+                break
+            node._parent._stale.add(node._name)
+            prefix = node._name + "/" + prefix
+            node = node._parent
+        if node._index is None and node._fingerprints is None:
+            return
+        # The root indexes the whole subtree of value under its path
+        entries = [(prefix + key, value)]
+        if isinstance(value, SshKeyDict):
+            entries.extend((prefix + key + "/" + path, entry)
+                           for path, entry in value._entries())
+        if node._index is not None:
+            if insert:
+                node._index.update(entries)
+            else:
+                for path, _ in entries:
+                    del node._index[path]
+        if node._fingerprints is not None:
+            for path, entry in entries:
+                if not isinstance(entry, SshKey):
+                    continue
+                if insert:
+                    node._fingerprints.setdefault(
+                        entry.digest(), {})[path] = None
+                else:
+                    paths = node._fingerprints[entry.digest()]
+                    del paths[path]
+                    if not paths:
+                        del node._fingerprints[entry.digest()]
+
+    def find(self, path: str) -> Optional[Union[SshKey, SshKeyDict]]:
+        index, prefix = self._paths()
+        return index.get(prefix + path)
+
+    def select(self, pattern: str) -> List[str]:
+        # Paths of the keys at or under the path pattern, or matching it
+        # as a glob if it has wildcards, only the subtree before the first
+        # of them is walked
+        parts = [part for part in pattern.split("/") if part]
+        literal = 0
+        while literal < len(parts) and not any(
+                char in parts[literal] for char in "*?["):
+            literal += 1
+        prefix = "/".join(parts[:literal])
+        found = self.find(prefix) if prefix else self
+        if found is None:
+            return []
+        if isinstance(found, SshKey):
+            paths = [prefix]
+        elif prefix:
+            paths = [prefix + "/" + path for path in found.list_key()]
+        else:
+            paths = found.list_key()
+        if literal == len(parts):
+            return paths
+        # Matched name by name, so that a wildcard stays in one group
+        globs = parts[literal:]
+        found = []
+        for path in paths:
+            names = path.split("/")[literal:]
+            if len(names) == len(globs) and all(
+                    map(fnmatchcase, names, globs)):
+                found.append(path)
+        return found
+
+    def paths_of(self, key: Union[SshKey, str]) -> List[str]:
+        # key is a SshKey or a fingerprint as given by SshKey.fingerprint
+        if isinstance(key, SshKey):
+            digest = key.digest()
+        else:
+            if not key.startswith("SHA256:"):
+                raise ValueError(key + " is not a SHA256 fingerprint.")
+            encoded = key[len("SHA256:"):]
+            try:
+                digest = base64.b64decode(encoded + "=" * (-len(encoded) % 4),
+                                          validate=True)
+            except binascii.Error as error:
+                raise ValueError(key + " is not a SHA256 fingerprint."
+                                 ) from error
+        # Looked up in the index of the root, under the path of self
+        root, prefix = self._root()
+        fingerprints = root._fingerprints
+        if fingerprints is None:
+            fingerprints = {}
+            for path, entry in root._entries():
+                if isinstance(entry, SshKey):
+                    fingerprints.setdefault(entry.digest(), {})[path] = None
+            root._fingerprints = fingerprints
+        return [path[len(prefix):]
+                for path in fingerprints.get(digest, ())
+                if path.startswith(prefix)]
+
+    def duplicates(self, addition: SshKeyDict) -> List[str]:
+        # Paths of addition whose key is already somewhere else in self or
+        # earlier in addition
+        found = []
+        for path in addition.list_key():
+            ssh_key = addition.find(path)
+            assert isinstance(ssh_key, SshKey)
+            if (any(other != path for other in self.paths_of(ssh_key))
+                    or addition.paths_of(ssh_key)[0] != path):
+                found.append(path)
+        return found
+
+    def copy(self) -> SshKeyDict:
+        return SshKeyDict(self)
+
+    def digest(self) -> bytes:
+        # Only the groups changed since the last call are hashed again
+        todo: List[SshKeyDict] = [self]
+        while todo:
+            group = todo[-1]
+            if group._digest is not None:
+                todo.pop()
+                continue
+            stale = [value for value in map(group._content.__getitem__,
+                                            group._stale)
+                     if isinstance(value, SshKeyDict) and value._digest is None]
+            if stale:
+                todo.extend(stale)
+                continue
+            for key in group._stale:
+                term = _term(key, _entry_digest(group._content[key]))
+                group._sum = (group._sum - group._terms.get(key, 0)
+                              + term) % _MODULUS
+                group._terms[key] = term
+            group._stale.clear()
+            group._digest = hashlib.sha256(
+                b"S" + group._sum.to_bytes(64, "big")).digest()
+            todo.pop()
+        assert self._digest is not None
+        return self._digest
+
+    def digests(self) -> Dict[str, bytes]:
+        # Digest of each entry, as they make up the one of self
+        self.digest()
+        return {key: _entry_digest(value)
+                for key, value in self._content.items()}
+
+    def patch(self, digests: Dict[str, bytes]
+              ) -> Tuple[List[str], SshKeyDict]:
+        # The entries to delete from and to add to a tree made of entries
+        # with these digests so that it becomes equal to self
+        mine = self.digests()
+        deleted = [key for key, digest in digests.items()
+                   if mine.get(key) != digest]
+        added = SshKeyDict({})
+        for key, digest in mine.items():
+            if digests.get(key) != digest:
+                added[key] = self._content[key]
+        return deleted, added
+
+    @property
+    def version(self) -> str:
+        return self.digest().hex()
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, SshKeyDict):
+            return NotImplemented
+        return self.digest() == other.digest()
+
+    __hash__ = None  # type: ignore
+
+    @classmethod
+    def open(cls, filename: str = "/authorized_key",
+             offsets: Optional[Dict[str, int]] = None) -> SshKeyDict:
+        with open(filename, "rb") as file:
+            return cls.parse(file, offsets)
 
     @classmethod
-    def open(cls, filename: str = "/authorized_key") -> SshKeyDict:
-        def _aux(content: List[str]) -> Union[SshKeyDict, SshKey]:
-            if content == []:
-                return cls({})
-            line = content.pop()
+    def open_at(cls, filename: str,
+                offset: int) -> Union[SshKeyDict, SshKey]:
+        # offset comes from the offsets filled by open(), it must point to
+        # the header line of the wanted group or key.
+        with open(filename, "rb") as file:
+            file.seek(offset)
+            tree = cls.parse(file, position=offset, single=True)
+        if len(tree) != 1:
+            raise ValueError("No group or key at offset " + str(offset))
+        return next(iter(tree.values()))
+
+    @classmethod
+    def parse(cls, stream: BinaryIO,
+              offsets: Optional[Dict[str, int]] = None,
+              position: int = 0, single: bool = False) -> SshKeyDict:
+        # pylint: disable=R0914
+        # Single pass over the lines, the nesting is kept in an explicit
+        # stack of (depth, group, path) instead of the call stack.
+        root = cls({})
+        stack: List[Tuple[int, SshKeyDict, str]] = [(0, root, "")]
+        # Last header seen, waiting to know if it names a key or a group,
+        # and its line number
+        header: Optional[Tuple[int, str, SshKeyDict, str, int]] = None
+        base: Optional[int] = None
+        for number, raw in enumerate(stream, 1):
+            offset = position
+            position += len(raw)
+            line = raw.decode("utf-8").rstrip("\r\n")
+            if line.strip() == "":
+                continue
             if line[0] == "#":
-                count = 0
-                while line[count] == "#":
-                    count += 1
-                dic = cls({})
-                while line[:count+1] == "#"*count + " ":
-                    dic[line[count+1:-1]] = _aux(content)
-                    try:
-                        line = content.pop()
-                        while line == "\n":
-                            line = content.pop()
-                    except IndexError:
-                        return dic
-                content.append(line)
-                return dic
-            return SshKey.convert(line[:-1])
-        with open(filename, "r", encoding="utf-8") as file:
-            content = file.readlines()
-            content.reverse()
-            content = _aux(content)
-            if isinstance(content, SshKey):
-                return cls({"": content})
-            return content
-
-    def __repr__(self, index: int = 0) -> str:
-        index += 1
-        res = ""
-        for key, value in self.items():
-            res += "#"*index + " " + key + "\n"
-            if isinstance(value, SshKeyDict):
-                res += value.__repr__(index)
+                depth = len(line) - len(line.lstrip("#"))
+                if line[depth:depth+1] != " ":
+                    continue
+                if single:
+                    if base is None:
+                        base = depth
+                        stack[0] = (depth - 1, root, "")
+                    elif depth <= base:
+                        break
+                if header is not None:
+                    _check_group(header[1], header[4])
+                    group = cls({})
+                    header[2][header[1]] = group
+                    if depth > header[0]:
+                        stack.append((header[0], group,
+                                      _join(header[3], header[1])))
+                while stack[-1][0] >= depth:
+                    stack.pop()
+                name = line[depth+1:]
+                # A path separator would split the name in groups, an empty
+                # name only stands for the key of a file without headers,
+                # as written before they were left out for it
+                if "/" in name or (name == "" and (
+                        depth != 1 or len(root) > 0 or single)):
+                    raise ValueError("Line " + str(number) + ": invalid"
+                                     " name " + repr(name) + ".")
+                header = (depth, name, stack[-1][1], stack[-1][2], number)
+                if offsets is not None:
+                    offsets[_join(stack[-1][2], name)] = offset
+            elif header is not None:
+                header[2][header[1]] = SshKey.convert(line)
+                header = None
+            elif len(root) == 0 and len(stack) == 1 and not single:
+                root[""] = SshKey.convert(line)
+                if offsets is not None:
+                    offsets[""] = offset
             else:
-                res += str(value) + "\n"
-            res += "\n"
-        return res
+                raise ValueError("Line " + str(number)
+                                 + ": ssh key without a header.")
+        if header is not None:
+            _check_group(header[1], header[4])
+            header[2][header[1]] = cls({})
+        return root
+
+    def serialize(self, chunk_size: int = 1 << 16) -> Iterator[str]:
+        # Yields the file content in pieces of about chunk_size characters
+        parts: List[str] = []
+        size = 0
+        items: Iterator = iter(self.items())
+        single = self._content.get("")
+        if isinstance(single, SshKey):
+            # First and without a header, as parse() reads it
+            parts.append(str(single) + "\n\n")
+            size = len(parts[-1])
+            items = ((key, value) for key, value in self.items()
+                     if key != "")
+        todo: List[Tuple[int, Iterator]] = [(1, items)]
+        while todo:
+            depth, items = todo[-1]
+            for key, value in items:
+                parts.append("#"*depth + " " + key + "\n")
+                size += len(parts[-1])
+                if isinstance(value, SshKeyDict):
+                    todo.append((depth + 1, iter(value.items())))
+                    break
+                parts.append(str(value) + "\n\n")
+                size += len(parts[-1])
+                if size >= chunk_size:
+                    yield "".join(parts)
+                    parts = []
+                    size = 0
+            else:
+                todo.pop()
+                if todo:
+                    parts.append("\n")
+                    size += 1
+            if size >= chunk_size:
+                yield "".join(parts)
+                parts = []
+                size = 0
+        if parts:
+            yield "".join(parts)
+
+    def __repr__(self) -> str:
+        return "".join(self.serialize())
 
     def __str__(self) -> str:
         return self.__repr__()
 
-    def write(self, filename: str = "/authorized_key"):
-        with open(filename, "w", encoding="utf-8") as file:
-            file.write(str(self))
+    def write(self, filename: str = "/authorized_key") -> bool:
+        # The content goes to a temporary file next to the target which then
+        # replaces it, so sshd never reads a partial file. Returns False when
+        # the file already had this content and was left untouched, the
+        # temporary file is then dropped.
+        digest = hashlib.sha256()
+        directory = os.path.dirname(os.path.abspath(filename))
+        descriptor, temporary = tempfile.mkstemp(
+            prefix="." + os.path.basename(filename) + ".", dir=directory)
+        try:
+            with open(descriptor, "wb") as file:
+                for chunk in self.serialize():
+                    data = chunk.encode("utf-8")
+                    digest.update(data)
+                    file.write(data)
+                if digest.digest() == file_digest(filename):
+                    return False
+                file.flush()
+                os.fsync(file.fileno())
+            _replace(temporary, filename)
+            _DIGESTS[os.path.realpath(filename)] = (
+                _stamp(os.stat(filename)), digest.digest())
+            return True
+        finally:
+            if os.path.exists(temporary):
+                os.unlink(temporary)
 
     def add(self, addition: SshKeyDict) -> bool:
-        for key, value in addition.items():
-            if key in self:
-                old_value = self[key]
-                if isinstance(value, SshKeyDict):
-                    if isinstance(old_value, SshKeyDict):
-                        if not old_value.add(value):
-                            return False
-                    else:
-                        return False
-                elif isinstance(old_value, SshKeyDict):
-                    return False
+        # Check every path first so that a conflict leaves self untouched.
+        # A key can only replace a key, the groups of addition include the
+        # parents of its keys.
+        index, prefix = self._paths()
+        for path, entry in addition._entries():
+            found = index.get(prefix + path)
+            if found is not None and (isinstance(found, SshKey)
+                                      != isinstance(entry, SshKey)):
+                return False
+        todo: List[Tuple[SshKeyDict, SshKeyDict]] = [(self, addition)]
+        while todo:
+            target, source = todo.pop()
+            for key, value in source.items():
+                old_value = target._content.get(key)
+                if (isinstance(old_value, SshKeyDict)
+                        and isinstance(value, SshKeyDict)):
+                    todo.append((old_value, value))
                 else:
-                    self[key] = value
-            else:
-                self[key] = value
+                    target[key] = value
         return True
 
     def remove(self, key_name: str) -> bool:
-        key_begin = key_name.split('/')[0]
-        if key_begin not in self:
-            return False
-        value = self[key_begin]
-
-        if key_begin == key_name:
-            if isinstance(value, SshKey):
-                del self[key_begin]
-                return True
-            return False
-        if isinstance(value, SshKeyDict):
-            if value.remove(key_name[len(key_begin)+1:]):
-                if len(value) == 0:
-                    del self[key_begin]
-                return True
+        if not isinstance(self.find(key_name), SshKey):
             return False
-        return False
+        path, _, name = key_name.rpartition("/")
+        group = self.find(path) if path else self
+        assert isinstance(group, SshKeyDict)
+        del group[name]
+        while group is not self and len(group) == 0:
+            parent = group._parent
+            assert parent is not None
+            del parent[group._name]
+            group = parent
+        return True
 
     def diff(self, old_dict: SshKeyDict
              ) -> Dict[str, Union[SshKeyDict, List[str]]]:
         deleted = []
         added = SshKeyDict({})
+        if self.digest() == old_dict.digest():
+            return {"DEL": deleted,
+                    "ADD": added}
         for key, value in self.items():
             if key in old_dict:
                 old_value = old_dict[key]
@@ -266,7 +825,7 @@ class SshKeyDict(MutableMapping):
                     if isinstance(old_value, SshKey):
                         deleted.append(key)
                         added[key] = value
-                    else:
+                    elif value.digest() != old_value.digest():
                         tmp = value.diff(old_value)
                         for key_name in tmp["DEL"]:
                             assert isinstance(key_name, str)
@@ -288,11 +847,20 @@ class SshKeyDict(MutableMapping):
                 "ADD": added}
 
     def list_key(self) -> List[str]:
-        ret = []
-        for key, value in self.items():
-            if isinstance(value, SshKey):
-                ret.append(key)
-            else:
-                for key_name in value.list_key():
-                    ret.append(key + "/" + key_name)
-        return ret
+        listing = self._listing
+        if listing is None:
+            # Built aside, a concurrent reader must not see it partial
+            listing = []
+            todo: List[Tuple[str, Iterator]] = [("", iter(self.items()))]
+            while todo:
+                prefix, items = todo[-1]
+                for key, value in items:
+                    if isinstance(value, SshKey):
+                        listing.append(prefix + key)
+                    else:
+                        todo.append((prefix + key + "/", iter(value.items())))
+                        break
+                else:
+                    todo.pop()
+            self._listing = listing
+        return list(listing)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# @Author: Ultraxime
+# @Date:   2026-10-18 18:20:41
+# @Last Modified by:   Ultraxime
+# @Last Modified time: 2026-10-18 18:20:41
+
+"""Module use to check the ssh keys before they are added"""
+
+from __future__ import annotations
+
+import multiprocessing
+import struct
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from .ssh_keys import KeyMode, SshKey, SshKeyDict
+
+
+# Algorithm names a key blob may start with, for each mode
+ALGORITHMS = {
+    KeyMode.DSA: ("ssh-dss",),
+    KeyMode.ECDSA: ("ecdsa-sha2-nistp256", "ecdsa-sha2-nistp384",
+                    "ecdsa-sha2-nistp521"),
+    KeyMode.ECDSA_SK: ("sk-ecdsa-sha2-nistp256@openssh.com",),
+    KeyMode.ED25519: ("ssh-ed25519",),
+    KeyMode.ED25519_SK: ("sk-ssh-ed25519@openssh.com",),
+    KeyMode.RSA: ("ssh-rsa",),
+}
+
+_SIZE = struct.Struct(">I")
+
+# Keys sent to a process of the pool at once
+CHUNK_SIZE = 256
+
+
+def _read(blob: bytes, pos: int) -> Tuple[bytes, int]:
+    # A string of the ssh wire format, prefixed by its length
+    if pos + _SIZE.size > len(blob):
+        raise ValueError("truncated key")
+    size, = _SIZE.unpack_from(blob, pos)
+    pos += _SIZE.size
+    if pos + size > len(blob):
+        raise ValueError("truncated key")
+    return blob[pos:pos + size], pos + size
+
+
+def check(mode: KeyMode, blob: bytes, rsa_min_bits: int = 2048,
+          rsa_max_bits: int = 16384) -> Optional[str]:
+    """
+    Check that a key blob is well formed for its mode
+
+    :param      mode:          The mode of the key
+    :type       mode:          KeyMode
+    :param      blob:          The decoded key
+    :type       blob:          bytes
+    :param      rsa_min_bits:  The minimum size of a RSA modulus
+    :type       rsa_min_bits:  int
+    :param      rsa_max_bits:  The maximum size of a RSA modulus
+    :type       rsa_max_bits:  int
+
+    :returns:   the problem, None if the key is valid
+    :rtype:     str, optional
+    """
+    try:
+        name, pos = _read(blob, 0)
+        algorithm = name.decode("ascii")
+        if algorithm not in ALGORITHMS[mode]:
+            return algorithm + " key given as " + str(mode)
+        if mode is KeyMode.RSA:
+            exponent, pos = _read(blob, pos)
+            modulus, pos = _read(blob, pos)
+            bits = int.from_bytes(modulus, "big").bit_length()
+            if int.from_bytes(exponent, "big") % 2 == 0:
+                return "invalid RSA exponent"
+            if not rsa_min_bits <= bits <= rsa_max_bits:
+                return ("RSA modulus of " + str(bits) + " bits, expected "
+                        + str(rsa_min_bits) + " to " + str(rsa_max_bits))
+        elif mode is KeyMode.DSA:
+            for _ in range(4):
+                _, pos = _read(blob, pos)
+        elif mode in (KeyMode.ECDSA, KeyMode.ECDSA_SK):
+            curve, pos = _read(blob, pos)
+            if curve.decode("ascii") != \
+                    algorithm.rpartition("-")[2].partition("@")[0]:
+                return ("curve " + curve.decode("ascii") + " in a "
+                        + algorithm + " key")
+            point, pos = _read(blob, pos)
+            if not point or point[0] != 4:
+                return "invalid ECDSA point"
+        else:
+            public, pos = _read(blob, pos)
+            if len(public) != 32:
+                return "invalid ED25519 public key"
+        if mode in (KeyMode.ECDSA_SK, KeyMode.ED25519_SK):
+            _, pos = _read(blob, pos)
+        if pos != len(blob):
+            return "trailing data after the key"
+    except (ValueError, UnicodeDecodeError) as error:
+        return str(error)
+    return None
+
+
+def _check_all(keys: List[Tuple[KeyMode, bytes]], rsa_min_bits: int,
+               rsa_max_bits: int) -> List[Optional[str]]:
+    return [check(mode, blob, rsa_min_bits, rsa_max_bits)
+            for mode, blob in keys]
+
+
+class Validator:
+    """
+    Checks the keys of the trees to add, in a pool of processes for the
+    large ones, and remembers the result for each key
+    """
+    _rsa_bits: Tuple[int, int]
+    _processes: Optional[int]
+    _threshold: int
+    _cache_size: int
+    # (mode, sha256 of the blob) -> problem or None
+    _cache: Dict[Tuple[KeyMode, bytes], Optional[str]]
+    _pool: Optional[ProcessPoolExecutor]
+
+    def __init__(self, rsa_min_bits: int = 2048, rsa_max_bits: int = 16384,
+                 processes: Optional[int] = None, threshold: int = 1000,
+                 cache_size: int = 100000) -> None:
+        self._rsa_bits = (rsa_min_bits, rsa_max_bits)
+        self._processes = processes
+        self._threshold = threshold
+        self._cache_size = cache_size
+        self._cache = {}
+        self._pool = None
+
+    def validate(self, keys: SshKeyDict) -> Dict[str, str]:
+        """
+        Check every key of a tree
+
+        :param      keys:  The tree
+        :type       keys:  SshKeyDict
+
+        :returns:   the problem of each invalid key, by path
+        :rtype:     Dict[str, str]
+        """
+        return self.validate_all([keys])[0]
+
+    def validate_all(self, trees: List[SshKeyDict]) -> List[Dict[str, str]]:
+        """
+        Check every key of several trees at once, so that many small trees
+        are split between the processes as a large one would be
+
+        :param      trees:  The trees
+        :type       trees:  List[SshKeyDict]
+
+        :returns:   the problem of each invalid key by path, for each tree
+        :rtype:     List[Dict[str, str]]
+        """
+        found: List[List[Tuple[str, SshKey]]] = []
+        todo: Dict[Tuple[KeyMode, bytes], SshKey] = {}
+        for keys in trees:
+            entries = []
+            for path in keys.list_key():
+                ssh_key = keys.find(path)
+                assert isinstance(ssh_key, SshKey)
+                entries.append((path, ssh_key))
+                entry = (ssh_key.mode, ssh_key.digest())
+                if entry not in self._cache:
+                    todo[entry] = ssh_key
+            found.append(entries)
+        if todo:
+            self._check(todo)
+        results = []
+        for entries in found:
+            errors = {}
+            for path, ssh_key in entries:
+                error = self._cache.get((ssh_key.mode, ssh_key.digest()))
+                if error is not None:
+                    errors[path] = error
+            results.append(errors)
+        return results
+
+    def _check(self, todo: Dict[Tuple[KeyMode, bytes], SshKey]) -> None:
+        items = [(ssh_key.mode, ssh_key.blob) for ssh_key in todo.values()]
+        if len(items) < self._threshold:
+            results = _check_all(items, *self._rsa_bits)
+        else:
+            if self._pool is None:
+                # Not forked, the manager runs zmq and other threads
+                self._pool = ProcessPoolExecutor(
+                    self._processes, multiprocessing.get_context("spawn"))
+            chunks = [items[index:index + CHUNK_SIZE]
+                      for index in range(0, len(items), CHUNK_SIZE)]
+            results = [result for chunk in self._pool.map(
+                _check_all, chunks, [self._rsa_bits[0]] * len(chunks),
+                [self._rsa_bits[1]] * len(chunks)) for result in chunk]
+        if len(self._cache) + len(todo) > self._cache_size:
+            self._cache.clear()
+        self._cache.update(zip(todo, results))
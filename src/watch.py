@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+# @Author: Ultraxime
+# @Date:   2026-10-18 21:14:37
+# @Last Modified by:   Ultraxime
+# @Last Modified time: 2026-10-18 21:14:37
+
+"""
+Module use by the manager to notice the changes made by hand to its file,
+with inotify on Linux and by polling its modification time elsewhere
+"""
+
+from __future__ import annotations
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+from threading import Thread
+from typing import Callable, Optional, Tuple
+
+_LOGGER = logging.getLogger(__name__)
+
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+# Events of the directory, editors often save by renaming a new file
+_DIRECTORY_MASK = _IN_CLOSE_WRITE | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE
+# Events of the file itself, the only ones seen for a bind mounted file
+# changed from the host
+_FILE_MASK = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_ATTRIB
+
+# wd, mask, cookie, length of the name
+_EVENT = struct.Struct("iIII")
+
+
+def _inotify() -> Optional[Tuple[ctypes.CDLL, int]]:
+    # The libc and a new inotify descriptor, None where it is missing
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        descriptor = libc.inotify_init1(os.O_CLOEXEC | os.O_NONBLOCK)
+    except (OSError, AttributeError):
+        return None
+    if descriptor < 0:
+        return None
+    return libc, descriptor
+
+
+class Watcher(Thread):
+    """
+    Thread calling back once a file stopped changing for the debounce
+    delay, or max_delay after its first change during a burst of them
+    """
+    _path: str
+    _callback: Callable[[], object]
+    _debounce: float
+    _max_delay: float
+    _interval: float
+
+    def __init__(self, path: str, callback: Callable[[], object], *args,
+                 debounce: float = 0.5, max_delay: float = 2.0,
+                 interval: float = 1.0, **kwargs) -> None:
+        super().__init__(*args, daemon=True, **kwargs)
+        self._path = os.path.abspath(path)
+        self._callback = callback
+        self._debounce = debounce
+        self._max_delay = max_delay
+        self._interval = interval
+
+    def run(self):
+        inotify = _inotify()
+        if inotify is None:
+            _LOGGER.warning("inotify is not available, polling %s.",
+                            self._path)
+            self._poll()
+        else:
+            self._watch(*inotify)
+
+    def _changed(self) -> None:
+        try:
+            self._callback()
+        except Exception:  # pylint: disable=W0703
+            _LOGGER.exception("Failed to reload %s.", self._path)
+
+    def _watch(self, libc: ctypes.CDLL, descriptor: int) -> None:
+        directory, name = os.path.split(self._path)
+        directory_wd = libc.inotify_add_watch(
+            descriptor, directory.encode("utf-8"), _DIRECTORY_MASK)
+        if directory_wd < 0:
+            _LOGGER.warning("Cannot watch %s, polling %s.", directory,
+                            self._path)
+            os.close(descriptor)
+            self._poll()
+            return
+        while True:
+            # Added again each time, the file is replaced when it is saved
+            file_wd = libc.inotify_add_watch(
+                descriptor, self._path.encode("utf-8"), _FILE_MASK)
+            wds = (directory_wd, file_wd)
+            select.select([descriptor], [], [])
+            if not self._relevant(descriptor, wds, name.encode("utf-8")):
+                continue
+            deadline = time.monotonic() + self._max_delay
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not select.select(
+                        [descriptor], [], [],
+                        min(self._debounce, remaining))[0]:
+                    break
+                self._relevant(descriptor, wds, name.encode("utf-8"))
+            self._changed()
+
+    @staticmethod
+    def _relevant(inotify: int, descriptors: Tuple[int, int], name: bytes
+                  ) -> bool:
+        # Reads the pending events, True if one is about the file
+        try:
+            data = os.read(inotify, 65536)
+        except BlockingIOError:
+            return False
+        found = False
+        pos = 0
+        while pos + _EVENT.size <= len(data):
+            descriptor, _, _, length = _EVENT.unpack_from(data, pos)
+            event = data[pos + _EVENT.size:pos + _EVENT.size + length]
+            pos += _EVENT.size + length
+            if descriptor == descriptors[1] or (
+                    descriptor == descriptors[0]
+                    and event.rstrip(b"\0") == name):
+                found = True
+        return found
+
+    def _poll(self) -> None:
+        stamp = self._stamp()
+        while True:
+            time.sleep(self._interval)
+            if self._stamp() == stamp:
+                continue
+            deadline = time.monotonic() + self._max_delay
+            while time.monotonic() < deadline:
+                stamp = self._stamp()
+                time.sleep(min(self._debounce,
+                               max(deadline - time.monotonic(), 0)))
+                if self._stamp() == stamp:
+                    break
+            stamp = self._stamp()
+            self._changed()
+
+    def _stamp(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            status = os.stat(self._path)
+        except FileNotFoundError:
+            return None
+        return (status.st_ino, status.st_mtime_ns, status.st_size)
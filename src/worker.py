@@ -7,12 +7,42 @@
 from __future__ import annotations
 
 
+import logging
+import time
+from collections import deque
+from socket import gethostname
 from threading import Thread
-from zmq import Context
+from typing import (Any, Deque, Dict, Iterable, List, Optional, Set,
+                    Tuple)
+from zmq import Context, Socket
 import zmq
 
+from . import metrics
 from .config import Config
-from .ssh_keys import SshKeyDict
+from .locks import ReadWriteLock
+from .lookup import KeyIndex, LookupServer
+from .metrics import (DECODE_SECONDS, DIFF_SECONDS, MESSAGE_BYTES,
+                      PARSE_SECONDS, WRITE_SECONDS)
+from .protocol import ProtocolError, decode, encode, recv, send
+from .relay import AckForwarder, CatchUp, Forwarder
+from .ssh_keys import SshKey, SshKeyDict
+
+
+DEFAULT_CONFIG = "worker-config.yml"
+
+_LOGGER = logging.getLogger(__name__)
+
+APPLY_SECONDS = metrics.histogram("ssh_manager_apply_seconds",
+                                  "Time to apply a message, by kind.")
+RECEIVED = metrics.gauge("ssh_manager_received_sequence",
+                         "Sequence number of the last received message.")
+APPLIED = metrics.gauge("ssh_manager_applied_sequence",
+                        "Sequence number of the last message written to"
+                        " the file.")
+LAG = metrics.gauge("ssh_manager_lag",
+                    "Messages received but not written to the file yet.")
+RESYNCS = metrics.counter("ssh_manager_resync_total",
+                          "Catch up requests sent, by outcome.")
 
 
 class Listener(Thread):
@@ -23,68 +53,512 @@ class Listener(Thread):
         self._worker = worker
 
     def run(self):
-        config = Config()
+        config = self._worker.config
+        window = float(config.get("batch.window"))
+        max_latency = float(config.get("batch.max_latency"))
         context = Context()
         socket = context.socket(zmq.SUB)
         socket.connect("tcp://" + str(config.get("sockets.manager.ip"))
                        + ":" + str(config.get("sockets.manager.port")))
         socket.setsockopt_string(zmq.SUBSCRIBE, "")
+        # Subscribed first, so that nothing published after the answer is
+        # missed
+        self._worker.handshake()
+        self._worker.acknowledge()
         while True: # not self.is_closed():
-            print("Waiting for message.")
-            msg = socket.recv_pyobj()
-            print("Recv: ")
-            print(msg)
-            assert isinstance(msg, dict)
-            for key, value in msg.items():
-                assert isinstance(key, str)
-                match key:
-                    case "ADD":
-                        if isinstance(value, SshKeyDict):
-                            self._worker.add_key(value)
-                        else:
-                            assert isinstance(value, SshKeyDict)
-                    case "DEL":
-                        if isinstance(value, list):
-                            for key_name in value:
-                                assert isinstance(key_name, str)
-                                self._worker.del_key(key_name)
-                        else:
-                            assert isinstance(value, str)
-                    case "UPDATE":
-                        if isinstance(value, SshKeyDict):
-                            self._worker.update_key(value)
-                        else:
-                            assert isinstance(value, SshKeyDict)
-                    case _:
-                        raise ValueError(key + " is not a expect value for header of a message.")
+            self._receive(socket)
+            # Apply everything arriving within the window to the tree, then
+            # write it once. max_latency bounds how long the batch can grow.
+            deadline = time.monotonic() + max_latency
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not socket.poll(
+                        int(min(window, remaining) * 1000)):
+                    break
+                self._receive(socket)
+            self._worker.flush()
+            self._worker.acknowledge()
+
+    def _receive(self, socket: Socket):
+        data = socket.recv()
+        MESSAGE_BYTES.observe(len(data), socket="publish", direction="in")
+        try:
+            with DECODE_SECONDS.time():
+                msg = decode(data)
+        except ProtocolError as error:
+            _LOGGER.warning("Invalid message from the manager: %s", error)
+            return
+        assert isinstance(msg, dict)
+        _LOGGER.debug("Received", extra={"seq": msg.get("SEQ"),
+                                         "bytes": len(data)})
+        self._worker.receive(msg, data)
 
 
 class Worker:
+    # pylint: disable=R0902
+    # Holds the state of the listener, the relay and the lookup server,
+    # which all call back into it
+    config: Config
     _listener: Listener
+    _keys: SshKeyDict
+    _filename: str
+    # Subtree -> file receiving only that subtree, from files.projections
+    _projections: Dict[str, str]
+    # Files to rewrite on the next flush
+    _dirty: Set[str]
+    _context: Context
+    _snapshot_address: str
+    _timeout: float
+    # Position in the stream of deltas of the manager, None until known
+    _epoch: Optional[str]
+    _sequence: Optional[int]
+    # Frames of the last deltas received, for the workers below a relay
+    _log: Deque[bytes]
+    # Held as a writer while a message is applied, the threads of a relay
+    # read the keys
+    _lock: ReadWriteLock
+    # Sequence number of the last delta written to the file
+    _applied: Optional[int]
+    # Index of the keys written, for the lookups of sshd if lookup.socket
+    # is set
+    _index: Optional[KeyIndex]
+    # Paths of the keys added or removed since the last flush, None when
+    # the index has to be built again
+    _changed: Optional[Set[str]]
+    _by_user: bool
+    # Reports the applied sequence numbers to the manager
+    _acks: Socket
+    _node: str
+    _acked: Optional[int]
+    # When the oldest message not written to the file yet was received
+    _pending_since: Optional[float]
+    # When the last message of the manager was received, and since when
+    # its heartbeats show a sequence number the worker has not caught up
+    _heard: float
+    _behind_since: Optional[float]
+    # Seconds between two heartbeats, from the last catch up answer, None
+    # before it or when the manager sends none
+    _interval: Optional[float]
+    # Seconds from the reception of a message to its write, for the last
+    # flush
+    _delay: float
+    # Method, threshold and level of the compression of the catch up
+    # answers of a relay
+    _compression: Tuple[Optional[str], int, Optional[int]]
 
-    def __init__(self):
+    def __init__(self, config: Optional[Config] = None):
+        self.config = config or Config.shared(default=DEFAULT_CONFIG)
         self._listener = Listener(self)
+        config = self.config
+        self._filename = config.get("files.keys")
+        self._projections = {
+            subtree.strip("/"): filename for subtree, filename
+            in (config.get("files.projections", None) or {}).items()}
+        self._dirty = {self._filename, *self._projections.values()}
+        try:
+            with PARSE_SECONDS.time():
+                self._keys = SshKeyDict.open(self._filename)
+        except FileNotFoundError:
+            self._keys = SshKeyDict({})
+        except ValueError as error:
+            # The handshake fetches the whole tree from the manager
+            _LOGGER.error("Cannot read the keys, starting without them: %s",
+                          error)
+            self._keys = SshKeyDict({})
+        self._context = Context()
+        self._snapshot_address = (
+            "tcp://" + str(config.get("sockets.manager.ip"))
+            + ":" + str(config.get("sockets.snapshot.port")))
+        self._timeout = float(config.get("sync.timeout"))
+        self._epoch = None
+        self._sequence = None
+        self._log = deque(maxlen=int(config.get("sync.log_size", 1000)))
+        self._lock = ReadWriteLock()
+        self._applied = None
+        self._by_user = bool(config.get("lookup.by_user", False))
+        self._index = (KeyIndex(self._keys)
+                       if config.get("lookup.socket", None) is not None
+                       else None)
+        self._changed = set()
+        # Never blocks the listener, the acknowledgements are dropped while
+        # the manager is away
+        self._acks = self._context.socket(zmq.PUSH)
+        self._acks.setsockopt(zmq.SNDHWM, 16)
+        self._acks.setsockopt(zmq.LINGER, 0)
+        self._acks.connect("tcp://" + str(config.get("sockets.manager.ip"))
+                           + ":" + str(config.get("sockets.ack.port")))
+        self._node = str(config.get("node.name", None)
+                         or gethostname())
+        self._acked = None
+        self._pending_since = None
+        self._heard = time.monotonic()
+        self._behind_since = None
+        self._interval = None
+        self._delay = 0.0
+        self._compression = (config.get("compression.method", None),
+                             int(config.get("compression.threshold", 0)),
+                             config.get("compression.level", None))
 
-    def start(self):
+    def start(self, daemon: bool = False):
+        metrics.add_check(self.health)
+        metrics.serve(self.config.get("metrics.port", None))
+        if self._index is not None:
+            LookupServer(self.config.get("lookup.socket"),
+                         self.lookup).start()
+        if self.config.get("relay.port", None) is not None:
+            upstream = ("tcp://" + str(self.config.get("sockets.manager.ip"))
+                        + ":" + str(self.config.get("sockets.manager.port")))
+            Forwarder(upstream, self.config.get("relay.port")).start()
+            CatchUp(self, self._snapshot_address,
+                    self.config.get("relay.snapshot_port"),
+                    self._timeout).start()
+            if self.config.get("relay.ack_port", None) is not None:
+                AckForwarder(
+                    "tcp://" + str(self.config.get("sockets.manager.ip"))
+                    + ":" + str(self.config.get("sockets.ack.port")),
+                    self.config.get("relay.ack_port")).start()
+        self._listener.daemon = daemon
         self._listener.start()
 
+    @property
+    def applied(self) -> Optional[int]:
+        return self._applied
+
+    def health(self) -> List[str]:
+        # Problems reported by /health of the metrics server
+        problems = []
+        if not self._listener.is_alive():
+            problems.append("The listener thread is dead.")
+        pending_since = self._pending_since
+        behind_since = self._behind_since
+        max_lag = float(self.config.get("health.max_lag"))
+        now = time.monotonic()
+        if pending_since is not None and now - pending_since > max_lag:
+            problems.append("Received messages are not written after "
+                            + str(max_lag) + " seconds.")
+        # Without heartbeats, the manager is silent while nothing changes
+        if ((self._interval is not None or self._sequence is None)
+                and now - self._heard > max_lag):
+            problems.append("Nothing received from the manager for "
+                            + str(max_lag) + " seconds.")
+        if behind_since is not None and now - behind_since > max_lag:
+            problems.append("Behind the manager for more than "
+                            + str(max_lag) + " seconds.")
+        return problems
+
+    def acknowledge(self) -> None:
+        # Tells the manager the sequence number written to the file, once
+        if self._applied is None or self._applied == self._acked:
+            return
+        try:
+            send(self._acks, {"NODE": self._node, "EPOCH": self._epoch,
+                              "SEQ": self._applied,
+                              "HASH": self._keys.version,
+                              "DELAY": self._delay}, zmq.NOBLOCK)
+        except zmq.Again:
+            return
+        self._acked = self._applied
+
+    def receive(self, msg: Dict[str, Any],
+                frame: Optional[bytes] = None) -> None:
+        self._heard = time.monotonic()
+        with self._lock.write():
+            self._receive(msg, frame)
+
+    def _receive(self, msg: Dict[str, Any], frame: Optional[bytes]) -> None:
+        if "HEARTBEAT" in msg:
+            self._beat(msg.get("EPOCH"), msg["HEARTBEAT"], msg.get("HASH"))
+            return
+        sequence = msg.get("SEQ")
+        if not isinstance(sequence, int):
+            self.apply(msg)
+            return
+        if self._sequence is not None and msg.get("EPOCH") == self._epoch:
+            if sequence <= self._sequence:
+                # Already received with a catch up
+                return
+            if sequence > self._sequence + 1:
+                _LOGGER.warning("Missed deltas, catching up.", extra={
+                    "first": self._sequence + 1, "last": sequence - 1})
+                # A relay may answer without this message yet, it is then
+                # the next one
+                if (not self.resync(self._sequence)
+                        or self._sequence is None
+                        or sequence != self._sequence + 1
+                        or msg.get("EPOCH") != self._epoch):
+                    return
+        self.apply(msg)
+        self._record(msg, frame)
+        if self._pending_since is None:
+            self._pending_since = time.monotonic()
+        self._epoch = msg.get("EPOCH")
+        self._sequence = sequence
+        RECEIVED.set(sequence)
+        if self._applied is not None:
+            LAG.set(sequence - self._applied)
+        if msg.get("HASH") != self._keys.version:
+            _LOGGER.warning("Keys differ from the manager, fetching a"
+                            " snapshot.", extra={"seq": sequence})
+            self.resync(None)
+
+    def _beat(self, epoch: Any, sequence: Any, version: Any) -> None:
+        # The heartbeats carry the last sequence number of the manager, a
+        # worker which missed the last deltas would otherwise wait for the
+        # next one to notice it, and the digest of its keys
+        if not isinstance(sequence, int):
+            return
+        if (self._sequence is None or epoch != self._epoch
+                or sequence > self._sequence):
+            if self._behind_since is None:
+                self._behind_since = time.monotonic()
+            _LOGGER.warning("Behind the manager, catching up.", extra={
+                "seq": self._sequence, "last": sequence})
+            self.resync(self._sequence)
+        if (self._sequence is not None and epoch == self._epoch
+                and sequence <= self._sequence):
+            self._behind_since = None
+            if (sequence == self._sequence and isinstance(version, str)
+                    and version != self._keys.version):
+                _LOGGER.warning("Keys differ from the manager, fetching a"
+                                " snapshot.", extra={"seq": sequence})
+                self.resync(None)
+
+    def handshake(self) -> bool:
+        # Compares the keys read from the file with the ones of the manager
+        # at start, only the differing top level entries are sent back
+        start = time.monotonic()
+        with self._lock.write():
+            synced = self.resync(None)
+            self.flush()
+        _LOGGER.info("Handshake", extra={
+            "synced": synced, "seq": self._sequence,
+            "seconds": round(time.monotonic() - start, 6)})
+        return synced
+
+    def resync(self, since: Optional[int], patch: bool = True) -> bool:
+        # Without patch, the digests are not sent so that the answer is the
+        # whole tree
+        socket = self._context.socket(zmq.DEALER)
+        socket.connect(self._snapshot_address)
+        request: Dict[str, Any] = {"SINCE": since, "EPOCH": self._epoch,
+                                   "HASH": self._keys.version}
+        if patch:
+            request["DIGESTS"] = self._keys.digests()
+        try:
+            send(socket, request)
+            if not socket.poll(int(self._timeout * 1000)):
+                _LOGGER.error("No answer from the manager to the catch up"
+                              " request.")
+                RESYNCS.inc(outcome="timeout")
+                self._epoch = None
+                self._sequence = None
+                return False
+            reply = recv(socket)
+        except ProtocolError as error:
+            _LOGGER.error("Invalid catch up answer: %s", error)
+            RESYNCS.inc(outcome="invalid")
+            return False
+        finally:
+            socket.close(linger=0)
+        kind = next((kind for kind in ("SNAPSHOT", "PATCH", "DELTAS")
+                     if isinstance(reply, dict) and kind in reply), None)
+        if kind is None:
+            _LOGGER.error("Invalid catch up answer: %s", reply)
+            RESYNCS.inc(outcome="invalid")
+            return False
+        RESYNCS.inc(outcome=kind)
+        if "SNAPSHOT" in reply:
+            self.update_key(reply["SNAPSHOT"])
+            self._log.clear()
+            version = reply["HASH"]
+        elif "PATCH" in reply:
+            self.patch(reply["PATCH"]["DEL"], reply["PATCH"]["ADD"])
+            self._log.clear()
+            version = reply["HASH"]
+        else:
+            version = None
+            for delta in reply["DELTAS"]:
+                self._record(delta, encode(delta))
+                self.apply(delta)
+                version = delta["HASH"]
+        self._epoch = reply["EPOCH"]
+        self._sequence = reply["SEQ"]
+        self._interval = reply.get("INTERVAL")
+        RECEIVED.set(reply["SEQ"])
+        if version is not None and version != self._keys.version:
+            if kind == "PATCH":
+                _LOGGER.warning("Keys differ from the manager after a"
+                                " patch, fetching a snapshot.")
+                return self.resync(None, patch=False)
+            if since is None:
+                return False
+            return self.resync(None)
+        return True
+
+    def _record(self, msg: Dict[str, Any], frame: Optional[bytes]) -> None:
+        # Keeps the deltas a relay can send again, as they were received
+        if "UPDATE" in msg:
+            self._log.clear()
+        elif frame is not None and "SEQ" in msg:
+            self._log.append(frame)
+
+    def catch_up(self, since: Optional[int], epoch: Optional[str],
+                 digests: Optional[Dict[str, bytes]] = None
+                 ) -> Optional[bytes]:
+        # Answer of a relay to a worker below it, as the manager would
+        # answer, or None when the relay is behind the worker
+        with self._lock.read():
+            if self._epoch is None or self._sequence is None:
+                return None
+            reply = {"EPOCH": self._epoch, "SEQ": self._sequence,
+                     "INTERVAL": self._interval}
+            if since is not None and epoch == self._epoch:
+                if since > self._sequence:
+                    return None
+                # The log holds consecutive deltas up to self._sequence
+                first = self._sequence - len(self._log) + 1
+                if first <= since + 1:
+                    deltas = [decode(frame) for frame
+                              in list(self._log)[since + 1 - first:]]
+                    return encode(dict(reply, DELTAS=deltas),
+                                  *self._compression)
+            if digests is not None:
+                deleted, added = self._keys.patch(digests)
+                return encode(dict(reply, HASH=self._keys.version,
+                                   PATCH={"DEL": deleted, "ADD": added}),
+                              *self._compression)
+            return encode(dict(reply, HASH=self._keys.version,
+                               SNAPSHOT=self._keys), *self._compression)
+
+    def apply(self, msg: Dict[str, Any]) -> None:
+        kind = next((key for key in ("UPDATE", "ADD", "DEL") if key in msg),
+                    "NONE")
+        with APPLY_SECONDS.time(kind=kind):
+            self._apply(msg)
+
+    def _apply(self, msg: Dict[str, Any]) -> None:
+        for key, value in msg.items():
+            assert isinstance(key, str)
+            match key:
+                case "ADD":
+                    if isinstance(value, SshKeyDict):
+                        self.add_key(value)
+                    else:
+                        assert isinstance(value, SshKeyDict)
+                case "DEL":
+                    if isinstance(value, list):
+                        for key_name in value:
+                            assert isinstance(key_name, str)
+                            self.del_key(key_name)
+                    else:
+                        assert isinstance(value, str)
+                case "UPDATE":
+                    if isinstance(value, SshKeyDict):
+                        self.update_key(value)
+                    else:
+                        assert isinstance(value, SshKeyDict)
+                case "EPOCH" | "SEQ" | "HASH":
+                    pass
+                case _:
+                    raise ValueError(key + " is not a expect value for header of a message.")
+
     def add_key(self, dic: SshKeyDict) -> bool:
-        old_dict = self.list_key()
-        if old_dict.add(dic):
-            old_dict.write()
-            return True
-        return False
+        if not self._keys.add(dic):
+            return False
+        # An addition of empty groups has no key paths
+        paths = dic.list_key()
+        self._touch(paths or list(dic))
+        if self._index is not None and self._changed is not None:
+            self._changed.update(paths)
+        return True
 
     def del_key(self, key_name: str) -> bool:
-        old_dict = self.list_key()
-        if old_dict.remove(key_name):
-            old_dict.write()
-            return True
-        return False
+        if not self._keys.remove(key_name):
+            return False
+        self._touch((key_name,))
+        if self._index is not None and self._changed is not None:
+            self._changed.add(key_name)
+        return True
+
+    def patch(self, deleted: List[str], added: SshKeyDict) -> bool:
+        # Replaces whole top level entries, as answered to a handshake
+        for name in deleted:
+            if name not in self._keys:
+                continue
+            if self._index is not None and self._changed is not None:
+                # The lines of the keys under it leave the index
+                found = self._keys[name]
+                self._changed.update(
+                    (name + "/" + path for path in found.list_key())
+                    if isinstance(found, SshKeyDict) else (name,))
+            del self._keys[name]
+        self._touch(deleted)
+        return self.add_key(added)
+
+    def _touch(self, paths: Iterable[str]) -> None:
+        # Marks the files showing any of the paths as to rewrite
+        self._dirty.add(self._filename)
+        for path in paths:
+            for subtree, filename in self._projections.items():
+                if (subtree == "" or path == subtree
+                        or path.startswith(subtree + "/")
+                        or subtree.startswith(path + "/")):
+                    self._dirty.add(filename)
 
     def update_key(self, new_dict: SshKeyDict) -> bool:
-        new_dict.write()
+        with DIFF_SECONDS.time():
+            delta = new_dict.diff(self._keys)
+        deleted = delta["DEL"]
+        assert isinstance(deleted, list)
+        for key_name in deleted:
+            self.del_key(key_name)
+        added = delta["ADD"]
+        assert isinstance(added, SshKeyDict)
+        if not self.add_key(added) or self._keys != new_dict:
+            # The diff does not carry empty groups, start over in that case
+            self._keys.clear()
+            self._dirty.update((self._filename, *self._projections.values()))
+            self._changed = None
+            return self._keys.add(new_dict)
         return True
 
     def list_key(self) -> SshKeyDict:
-        return SshKeyDict.open()
+        return self._keys
+
+    def lookup(self, user: Optional[str],
+               fingerprint: Optional[str]) -> List[str]:
+        # Called from the threads of the lookup server, the index is
+        # updated at each flush
+        index = self._index
+        if index is None:
+            return []
+        return index.lookup(user if self._by_user else None, fingerprint)
+
+    def flush(self) -> bool:
+        written = False
+        for subtree, filename in self._projections.items():
+            if filename not in self._dirty:
+                continue
+            found = self._keys.find(subtree) if subtree else self._keys
+            if isinstance(found, SshKey):
+                found = SshKeyDict({subtree.rpartition("/")[2]: found})
+            with WRITE_SECONDS.time(file=filename):
+                written |= (found or SshKeyDict({})).write(filename)
+        if self._filename in self._dirty:
+            with WRITE_SECONDS.time(file=self._filename):
+                written |= self._keys.write(self._filename)
+        if self._index is not None:
+            if self._changed is None:
+                self._index = KeyIndex(self._keys)
+            else:
+                self._index.update(self._keys, self._changed)
+        self._changed = set()
+        self._dirty.clear()
+        if self._pending_since is not None:
+            self._delay = time.monotonic() - self._pending_since
+            self._pending_since = None
+        self._applied = self._sequence
+        if self._applied is not None:
+            APPLIED.set(self._applied)
+            LAG.set(0)
+        return written
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of the index answering the lookups of sshd"""
+
+import base64
+
+from src.lookup import KeyIndex
+from src.ssh_keys import KeyMode, SshKey, SshKeyDict
+
+
+def _key(seed: bytes) -> SshKey:
+    return SshKey(KeyMode.ED25519, base64.b64encode(seed).decode("ascii"))
+
+
+def test_update_matches_a_new_index():
+    keys = SshKeyDict({"alice/a": _key(b"a"), "bob/b": _key(b"b")})
+    index = KeyIndex(keys)
+    keys.remove("alice/a")
+    keys.add(SshKeyDict({"bob/alice/c": _key(b"c")}))
+    index.update(keys, ["alice/a", "bob/alice/c"])
+    fresh = KeyIndex(keys)
+    for user in ("alice", "bob", None):
+        assert sorted(index.lookup(user)) == sorted(fresh.lookup(user))
+        for seed in (b"a", b"b", b"c"):
+            fingerprint = _key(seed).fingerprint
+            assert (index.lookup(user, fingerprint)
+                    == fresh.lookup(user, fingerprint))
+    assert index.lookup("alice") == [str(_key(b"c"))]
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of the batches applied by the manager"""
+
+import base64
+from pathlib import Path
+from typing import Iterator
+
+import pytest
+
+from src.config import Config
+from src.manager import Manager
+from src.protocol import decode
+from src.ssh_keys import KeyMode, SshKey, SshKeyDict
+
+
+def _key(seed: bytes) -> SshKey:
+    return SshKey(KeyMode.ED25519, base64.b64encode(seed).decode("ascii"))
+
+
+def _config(directory: Path, extra: str = "") -> Config:
+    # The publisher binds any free port, the threads are not started
+    config = directory / "manager.yml"
+    config.write_text(
+        "sockets:\n"
+        "  worker:\n"
+        "    port: '*'\n"
+        "files:\n"
+        "  keys: " + str(directory / "authorized_key") + "\n"
+        "  journal: " + str(directory / "journal") + "\n"
+        "  snapshot: " + str(directory / "snapshot") + "\n" + extra,
+        encoding="utf-8")
+    return Config(str(config), "manager-config.yml")
+
+
+@pytest.fixture(name="manager")
+def fixture_manager(tmp_path: Path) -> Iterator[Manager]:
+    SshKeyDict({"g/a": _key(b"a"), "g/b": _key(b"b")}).write(
+        str(tmp_path / "authorized_key"))
+    manager = Manager(_config(tmp_path))
+    try:
+        yield manager
+    finally:
+        manager.close()
+
+
+def test_missing_keys_and_journal_refused(tmp_path: Path):
+    with pytest.raises(FileNotFoundError):
+        Manager(_config(tmp_path))
+    manager = Manager(_config(tmp_path, "  allow_missing: true\n"))
+    try:
+        assert manager.list_key().key_count() == 0
+    finally:
+        manager.close()
+
+
+@pytest.mark.parametrize("destination", ["x//y", "/x", "x/"])
+def test_move_to_invalid_path_fails(manager: Manager, destination: str):
+    version = manager.list_key().version
+    sequence = manager.sequence
+    applied, results = manager.batch([{"DEL": "g/b"},
+                                      {"MOVE": ["g/a", destination]}])
+    assert not applied
+    assert results == ["ACK", "FAIL"]
+    assert manager.list_key().version == version
+    assert manager.list_key().list_key() == ["g/a", "g/b"]
+    assert manager.sequence == sequence
+
+
+@pytest.mark.parametrize("source", ["g//a", "/g/a", "g/a/"])
+def test_move_from_invalid_path_fails(manager: Manager, source: str):
+    applied, results = manager.batch([{"MOVE": [source, "x"]}])
+    assert not applied
+    assert results == ["FAIL"]
+    assert manager.list_key().list_key() == ["g/a", "g/b"]
+
+
+def test_move_group(manager: Manager):
+    applied, _ = manager.batch([{"MOVE": ["g", "x/y"]}])
+    assert applied
+    assert manager.list_key().list_key() == ["x/y/a", "x/y/b"]
+    assert manager.find_key("g") is None
+
+
+def test_catch_up_advertises_heartbeat_interval(manager: Manager,
+                                                tmp_path: Path):
+    assert decode(manager.catch_up(None, None))["INTERVAL"] == 5.0
+    silent = Manager(_config(tmp_path, "heartbeat:\n  interval: null\n"))
+    try:
+        assert decode(silent.catch_up(None, None))["INTERVAL"] is None
+    finally:
+        silent.close()
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+
+"""Tests of the write behind of the keys"""
+
+import time
+from pathlib import Path
+
+from src.locks import ReadWriteLock
+from src.persistence import WriteBehind
+from src.ssh_keys import SshKeyDict
+
+
+def test_failed_write_reported_and_retried(tmp_path: Path):
+    filename = tmp_path / "missing" / "authorized_key"
+    writer = WriteBehind(SshKeyDict({}), ReadWriteLock(), [str(filename)], 0)
+    writer.start()
+    writer.touch()
+    deadline = time.monotonic() + 5
+    while writer.error is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert writer.is_alive() and writer.error is not None
+    filename.parent.mkdir()
+    while writer.error is not None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert writer.error is None and filename.exists()